@@ -3,11 +3,14 @@ import urllib.parse as up
 
 from werkzeug.middleware.proxy_fix import ProxyFix
 from flask import url_for, make_response, jsonify
+from flask_jwt_extended import jwt_required
 from flask_migrate import Migrate, MigrateCommand
+from flask_security import roles_required
 from flask_script import Manager
 
 from src import api, db, ma, create_app, configs, bp, security, admin, celery, serializer_helper, sentry,\
-    redis_store, sms, url_shortener, limiter, jwt, razor
+    redis_store, sms, url_shortener, limiter, jwt, razor, http_pool, async_http, outbox
+from src.utils.api import set_user
 
 
 config = os.environ.get('PYTH_SRVR', 'default')
@@ -15,7 +18,7 @@ config = os.environ.get('PYTH_SRVR', 'default')
 config = configs.get(config)
 
 extensions = [api, db, ma, security, admin, celery, serializer_helper, sentry, redis_store,
-              sms, url_shortener, limiter, jwt, razor]
+              http_pool, sms, url_shortener, limiter, jwt, razor, async_http, outbox]
 bps = [bp]
 
 app = create_app(__name__, config, extensions=extensions, blueprints=bps)
@@ -62,11 +65,54 @@ def worker(application, concurrency, pool, debug, logfile, name, queue):
     celery.start()
 
 
+@manager.option('-o', '--owner', dest='owner_id', default=None)
+@manager.option('-v', '--verify', dest='verify', action='store_true', default=False)
+def rebuild_balances(owner_id, verify):
+    from src.dues.models import Due
+    from src.user.models import UserToUser
+    print('{0} paid dues without paid_on {1}'.format(Due.backfill_paid_on(verify_only=verify),
+                                                     'found' if verify else 'backfilled'))
+    drifted = UserToUser.rebuild_balances(business_owner_id=owner_id, verify_only=verify)
+    for row in drifted:
+        print('owner={0} customer={1} outstanding {2} -> {3} subscriptions {4} -> {5}'.format(
+            row.business_owner_id, row.customer_id, row.outstanding_amount, row.expected_amount,
+            row.active_subscriptions, row.expected_subscriptions))
+    print('{0} drifted balances {1}'.format(len(drifted), 'found' if verify else 'repaired'))
+
+
+@manager.option('-o', '--owner', dest='owner_id', default=None)
+def rebuild_rollups(owner_id):
+    from src.dues.models import DueDailyRollup
+    DueDailyRollup.rebuild(creator_id=owner_id)
+    print('due rollups rebuilt')
+
+
+@manager.option('-o', '--owner', dest='owner_id', required=True)
+def provision_customers(owner_id):
+    from src.dues.celerytasks import provision_customers
+    provision_customers.delay(int(owner_id))
+    print('razorpay customers queued for provisioning')
+
+
+@manager.command
+def relay_outbox():
+    outbox.run()
+
+
 @app.route('/api/v1/health', methods=['GET'])
 def status():
     return make_response(jsonify({'success': True, "message": 'Success', 'count': 0}), 200)
 
 
+@app.route('/api/v1/health/http', methods=['GET'])
+@jwt_required
+@set_user
+@roles_required('admin')
+def http_status():
+    # connection pool details of the process serving the request
+    return make_response(jsonify(http_pool.stats()), 200)
+
+
 @limiter.exempt
 @app.route('/api/v1/ping', methods=['GET'])
 def ping():
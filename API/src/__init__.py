@@ -1,7 +1,8 @@
 from .config import configs
 from .utils import api, db, ma, create_app, ReprMixin, bp, BaseMixin, admin, BaseSchema, BaseView, \
     AssociationView, celery, serializer_helper,\
-    sentry, redis_store, sms, url_shortener, limiter, DataResource, DataView, jwt, razor
+    sentry, redis_store, sms, url_shortener, limiter, DataResource, DataView, jwt, razor, http_pool, \
+    async_http, outbox
 
 from .admin_panel import admin_manager
 
@@ -41,6 +41,73 @@ class BaseConfig:
     MSG91_KEY = os.environ.get('MSG91_KEY')
     MSG91_URL = 'http://api.msg91.com/api/v2/sendsms'
 
+    CUSTOMER_CACHE_SIZE = 1024
+    CUSTOMER_CACHE_LOCAL_TIMEOUT = 30
+    CUSTOMER_CACHE_TIMEOUT = 600
+
+    RAZORPAY_PLAN_CACHE_TIMEOUT = 7 * 24 * 60 * 60
+    RAZORPAY_PROVISION_CHUNK_SIZE = 500
+    RAZORPAY_PROVISION_CONCURRENCY = 20
+    RAZOR_PAY_WEBHOOK_SECRET = None
+    RAZORPAY_EVENT_BATCH_SIZE = 500
+    RAZORPAY_EVENT_POLL_INTERVAL = 5
+    RAZORPAY_EVENT_RETRY_INTERVAL = 60
+    RAZORPAY_EVENT_MAX_ATTEMPTS = 30
+    # provider calls that failed inside a task are sent again after RAZORPAY_RETRY_DELAY * attempt seconds
+    RAZORPAY_RETRY_DELAY = 5 * 60
+    RAZORPAY_MAX_RETRIES = 5
+
+    EXPORT_FOLDER = os.environ.get('EXPORT_FOLDER', os.path.join(os.path.dirname(basedir), 'exports'))
+    EXPORT_JOB_TIMEOUT = 24 * 60 * 60
+
+    # per host connection pools for outgoing integrations, 'default' applies to every other host
+    HTTP_POOL_CONFIG = {
+        'default': {'pool_size': 10, 'timeout': (3.05, 10), 'retries': 3, 'backoff_factor': 0.3},
+        'api.razorpay.com': {'pool_size': 20, 'timeout': (3.05, 30)},
+        'api.msg91.com': {'pool_size': 10, 'timeout': (3.05, 15)},
+    }
+
+    # in-flight provider calls per worker process for celery tasks using async_http
+    ASYNC_HTTP_CONCURRENCY = 100
+    ASYNC_HTTP_CONCURRENCY_PER_HOST = 50
+    ASYNC_HTTP_TIMEOUT = 30
+    ASYNC_HTTP_RETRIES = 3
+
+    OUTBOX_BATCH_SIZE = 500
+    OUTBOX_POLL_INTERVAL = 0.5
+    OUTBOX_MAX_BACKOFF = 30
+
+    SMS_BATCH_SIZE = 500
+    SMS_FLUSH_INTERVAL = 10
+    SMS_MAX_ATTEMPTS = 3
+    SMS_STATUS_TIMEOUT = 24 * 60 * 60
+
+    DUE_ROLLUP_OVERLAP = 10 * 60
+    REMINDER_BATCH_SIZE = 5000
+    REMINDER_CHUNK_SIZE = 100
+    CELERYBEAT_SCHEDULE = {
+        'refresh-due-rollups': {
+            'task': 'celery.refresh_due_rollups',
+            'schedule': 60.0,
+        },
+        'send-due-reminders': {
+            'task': 'celery.send_due_reminders',
+            'schedule': 15 * 60.0,
+        },
+        'flush-sms-queues': {
+            'task': 'celery.flush_sms_queues',
+            'schedule': float(SMS_FLUSH_INTERVAL),
+        },
+        'process-razorpay-events': {
+            'task': 'celery.process_razorpay_events',
+            'schedule': float(RAZORPAY_EVENT_POLL_INTERVAL),
+        },
+        'cleanup-exports': {
+            'task': 'celery.cleanup_exports',
+            'schedule': 60 * 60.0,
+        },
+    }
+
     BROKER_URL = os.environ.get('REDIS_URL') #'amqp://guest:@127.0.0.1:5672/'
     CELERY_RESULT_BACKEND = os.environ.get('REDIS_URL')
     CELERY_BROKER_URL = os.environ.get('REDIS_URL')
@@ -61,6 +128,7 @@ class DevConfig(BaseConfig):
     RATELIMIT_STORAGE_URL = os.environ.get('REDIS_URL')
     RAZOR_PAY_KEY = os.environ.get('DEV_RAZOR_PAY_KEY')
     RAZOR_PAY_SECRET = os.environ.get('DEV_RAZOR_PAY_SECRET')
+    RAZOR_PAY_WEBHOOK_SECRET = os.environ.get('DEV_RAZOR_PAY_WEBHOOK_SECRET')
 
     #BROKER_URL = "redis://:@localhost:6379/0" #'amqp://guest:@127.0.0.1:5672/'
     #CELERY_RESULT_BACKEND = "redis://:@localhost:6379/0"
@@ -95,6 +163,7 @@ class ProdConfig(BaseConfig):
     DOMAIN = os.environ.get('PROD_DOMAIN')
     RAZOR_PAY_KEY = os.environ.get('PROD_RAZOR_PAY_KEY')
     RAZOR_PAY_SECRET = os.environ.get('PROD_RAZOR_PAY_SECRET')
+    RAZOR_PAY_WEBHOOK_SECRET = os.environ.get('PROD_RAZOR_PAY_WEBHOOK_SECRET')
 
 
 configs = {
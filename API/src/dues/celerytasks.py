@@ -1,109 +1,335 @@
 ''' Celery Tasks '''
 
-from src import db, razor as razorpay, sms, celery, url_shortener
+import asyncio
+import time
+from datetime import datetime, timedelta
+
+from flask import current_app
+from razorpay.constants import URL
+from razorpay.errors import BadRequestError, ServerError
+from sqlalchemy.exc import DataError, SQLAlchemyError
+from sqlalchemy.orm import joinedload, load_only
+
+from src import db, sms, celery, redis_store, async_http, outbox, sentry
+from src.utils.resource import chunked
+from src.user.models import User, UserToUser
+from .models import DueDailyRollup, RazorpayPlan, RazorpayEvent, REMINDER_BEFORE_DUE_DATE, REMINDER_ON_DUE_DATE
 from .schemas import Due
 
-# Send reminder on due-date
-@celery.task(name="celery.sms_on_due_date")
-def sms_on_due_date(obj_id):
-    dueObj = Due.query.get(obj_id)
 
-    # Only execute if payment is not done
-    if dueObj.due_date is not None:
+def report_failure(message, error):
+    # exceptions gathered from provider calls are reported after the fact, outside their except block
+    sentry.captureException(exc_info=(type(error), error, error.__traceback__), extra={'message': message})
+
+
+def retry_later(task, attempt, *args):
+    # work whose provider calls failed is sent to the task again with a growing delay
+    if attempt < current_app.config['RAZORPAY_MAX_RETRIES']:
+        task.apply_async(args, {'attempt': attempt + 1},
+                         countdown=current_app.config['RAZORPAY_RETRY_DELAY'] * (attempt + 1))
+
+
+def reminder_message(due, stage):
+    if stage == REMINDER_BEFORE_DUE_DATE:
+        return f'3 days remaining of your {due.creator.business_name} subscription! Pay now.'
+    return f'Failure to pay today will result in halt of your {due.creator.business_name} service! Pay Now!'
+
+
+def send_claimed_reminders(due_ids, stage):
+    dues = Due.query.options(joinedload(Due.creator), joinedload(Due.customer)).filter(Due.id.in_(due_ids)).all()
+    content = [dict(message=reminder_message(due, stage), to=[due.customer.mobile_number]) for due in dues]
+    if content:
+        sms.queue_sms(content)
+
+
+@celery.task(name="celery.send_due_reminders")
+def send_due_reminders():
+    # claim the dues whose reminder window is open in batches off ix_due_reminder and fan them out
+    batch_size = current_app.config['REMINDER_BATCH_SIZE']
+    claimed = 0
+    for stage in (REMINDER_ON_DUE_DATE, REMINDER_BEFORE_DUE_DATE):
+        while True:
+            due_ids = Due.claim_reminders(db.session.connection(), stage, limit=batch_size)
+            db.session.commit()
+            for chunk in chunked(due_ids, current_app.config['REMINDER_CHUNK_SIZE']):
+                send_reminders.delay(chunk, stage)
+            claimed += len(due_ids)
+            if len(due_ids) < batch_size:
+                break
+    return claimed
+
 
-        content= [dict(
-        message=f'3 days remaining of your {dueObj.creator.business_name} subscription! Pay now.',
-        to=[dueObj.customer.mobile_number]
-        )]
+@celery.task(name="celery.send_reminders")
+def send_reminders(due_ids, stage):
+    send_claimed_reminders(due_ids, stage)
 
-        sms.send_sms(content=content)
 
-# Send reminder 3 dasy before due-date
+# Send reminder on due-date, kept for ETA tasks queued before the sweeper; only sends if the due is still unclaimed
+@celery.task(name="celery.sms_on_due_date")
+def sms_on_due_date(obj_id):
+    due_ids = Due.claim_reminders(db.session.connection(), REMINDER_ON_DUE_DATE, due_ids=[obj_id])
+    db.session.commit()
+    if due_ids:
+        send_claimed_reminders(due_ids, REMINDER_ON_DUE_DATE)
+
+
+# Send reminder 3 days before due-date, see sms_on_due_date
 @celery.task(name="celery.sms_before_3_days")
 def sms_before_3_days(obj_id):
-    dueObj = Due.query.get(obj_id)
+    due_ids = Due.claim_reminders(db.session.connection(), REMINDER_BEFORE_DUE_DATE, due_ids=[obj_id])
+    db.session.commit()
+    if due_ids:
+        send_claimed_reminders(due_ids, REMINDER_BEFORE_DUE_DATE)
+
+
+def subscription_message(due, token):
+    payment_url = f'http://localhost:8000/do_payment.html?token={token}'
+    return dict(message=f'Thank you for your interest in the service provided by'
+                f' {due.creator.business_name}.Please complete your subscription and enjoy the service.'
+                f' Click to pay--> {payment_url}', to=[due.customer.mobile_number])
+
+
+def invoice_message(due, invoice_url):
+    return dict(message=f'Thank you for your interest in the service provided by'
+                f' {due.creator.business_name}. Here\'s your invoice and enjoy the service.\n'
+                f' Invoice --> \n {invoice_url}', to=[due.customer.mobile_number])
+
+
+def plan_data(due):
+    return {
+        "period": RazorpayPlan.PERIOD,
+        "interval": RazorpayPlan.INTERVAL,
+        "item": {
+            "name": due.name,
+            "description": due.name,
+            "amount": float(due.amount) * 100,
+            "currency": "INR"
+        }
+    }
+
 
-    # Only execute if payment is not done
-    if dueObj.due_date is not None:
+def subscription_data(due, plan_id, customer_id):
+    return dict(plan_id=plan_id, total_count=due.months, customer_notify=1, customer_id=customer_id,
+                start_at=time.mktime(due.due_date.timetuple()))
 
-        content= [dict(
-            message=f'Failure to pay today will result in halt of your {dueObj.creator.business_name} service! Pay Now!',
-            to=[dueObj.customer.mobile_number]
-            )]
 
-        sms.send_sms(content=content)
+def invoice_data(due):
+    return {
+        "customer": {
+            "name": due.customer.first_name,
+            "email": "",
+            "contact": due.customer.mobile_number
+        },
+        "type": "link",
+        "view_less": 1,
+        "amount": float(due.amount) * 100,
+        "currency": "INR",
+        "description": due.name,
+    }
 
-    #dueObj.due_date = None if payment is successful
+
+def customer_data(customer):
+    # with fail_existing=0 razorpay returns the customer it already has for the contact instead of an error, so
+    # customers created by a run that died before committing are picked up again
+    return {'name': customer.first_name, 'contact': customer.mobile_number, 'fail_existing': '0'}
+
+
+async def create_customers(session, customers, concurrency=None):
+    # stored ids are trusted as they are, only customers without one are created
+    customer_ids = {customer.id: customer.razor_pay_id for customer in customers if customer.razor_pay_id}
+    missing = [customer for customer in customers if not customer.razor_pay_id]
+    semaphore = asyncio.Semaphore(concurrency or len(missing) or 1)
+
+    async def create(customer):
+        async with semaphore:
+            return await session.razorpay('POST', URL.CUSTOMER_URL, customer_data(customer))
+
+    results = await asyncio.gather(*[create(customer) for customer in missing], return_exceptions=True)
+    for customer, result in zip(missing, results):
+        if isinstance(result, Exception):
+            report_failure("Couldn't create razorpay customer {0}".format(customer.id), result)
+        else:
+            customer.razor_pay_id = customer_ids[customer.id] = result['id']
+    return customer_ids
+
+
+async def create_payment_link(session, due, customer_id, plans):
+    if due.transaction_type == 'subscription':
+        plan_id = plans.get(RazorpayPlan.key(due))
+        if plan_id is None:
+            raise ServerError("Plan wasn't created")
+        return await session.razorpay('POST', URL.SUBSCRIPTION_URL, subscription_data(due, plan_id, customer_id))
+    return await session.razorpay('POST', URL.INVOICE_URL, invoice_data(due))
+
+
+async def create_plans(session, dues, plans):
+    # one razorpay plan per distinct plan missing from the registry, added to `plans` as they are created
+    missing = {}
+    for due in dues:
+        if due.transaction_type == 'subscription' and RazorpayPlan.key(due) not in plans:
+            missing.setdefault(RazorpayPlan.key(due), due)
+    results = await asyncio.gather(*[session.razorpay('POST', URL.PLAN_URL, plan_data(due))
+                                     for due in missing.values()], return_exceptions=True)
+    created = {}
+    for key, result in zip(missing, results):
+        if isinstance(result, Exception):
+            report_failure("Couldn't create razorpay plan {0}".format(key), result)
+        else:
+            plans[key] = created[key] = result['id']
+    return created
+
+
+async def create_payment_links(session, dues, plans):
+    # missing razorpay customers and one plan per distinct new plan first, then every due's subscription or
+    # invoice concurrently
+    customer_ids = await create_customers(session, list({due.customer_id: due.customer for due in dues}.values()))
+    skipped = [(due, ServerError("Customer wasn't created")) for due in dues if due.customer_id not in customer_ids]
+    dues = [due for due in dues if due.customer_id in customer_ids]
+    created = await create_plans(session, dues, plans)
+    results = await asyncio.gather(*[create_payment_link(session, due, customer_ids[due.customer_id], plans)
+                                     for due in dues], return_exceptions=True)
+    return list(zip(dues, results)) + skipped, created
 
 
 # Send invoice after payment
 @celery.task(name="celery.send_invoice")
 def send_invoice(invoice_url, obj_id):
     dueObj = Due.query.get(obj_id)
-    content = [dict(message=f'Thank you for your interest in the service provided by'
-            f' {dueObj.creator.business_name}. Here\'s your invoice and enjoy the service.\n'
-            f' Invoice --> \n {invoice_url}', to=[dueObj.customer.mobile_number])]
-            
-    sms.send_sms(content=content)
+    if isinstance(invoice_url, dict):
+        # tasks queued before the invoice link was passed on its own carry the whole invoice
+        invoice_url = invoice_url.get('short_url')
+    sms.queue_sms([invoice_message(dueObj, invoice_url)])
+
 
 @celery.task(name="celery.do_payment")
 def do_payment(obj_id):
-    obj = Due.query.get(obj_id)
-    if obj.customer.razor_pay_id:
-        customer = razorpay.customer.fetch(customer_id=obj.customer.razor_pay_id)
-    else:
-        customer = razorpay.customer.create(
-            data={'name': obj.customer.first_name, 'contact': obj.customer.mobile_number})
-        obj.customer.razor_pay_id = customer['id']
-        db.session.commit()
-    print(customer)
-    
-    if obj.transaction_type == 'subscription':
-        plan = razorpay.plan.create(data={
-            "period": "monthly",
-            "interval": 1,
-            "item": {
-                "name": obj.name,
-                "description": obj.name,
-                "amount": float(obj.amount) * 100,
-                "currency": "INR"
-            }
-        })
-        import time
-        timestamp = time.mktime(obj.due_date.timetuple())
-        data = dict(plan_id=plan['id'], total_count=obj.months, customer_notify=1, customer_id=customer['id'],
-                    start_at=timestamp)
-        subscription = razorpay.subscription.create(data=data)
-        obj.razor_pay_id = subscription['id']
+    return do_payments([obj_id])
+
+
+@outbox.register_batchable
+@celery.task(name="celery.do_payments")
+def do_payments(obj_ids, attempt=0):
+    # the outbox delivers at least once, dues that already have a link are skipped and the ones being linked by a
+    # concurrent delivery stay locked until it commits
+    dues = Due.query.options(joinedload(Due.creator), joinedload(Due.customer))\
+        .filter(Due.id.in_(obj_ids), Due.razor_pay_id.is_(None)).with_for_update(skip_locked=True, of=Due).all()
+    plans = RazorpayPlan.lookup([RazorpayPlan.key(due) for due in dues if due.transaction_type == 'subscription'])
+    links, created = async_http.run(create_payment_links, dues, plans)
+    content, failed = [], []
+    for due, result in links:
+        if isinstance(result, Exception):
+            report_failure("Couldn't create payment link for due {0}".format(due.id), result)
+            failed.append(due.id)
+        elif due.transaction_type == 'subscription':
+            due.razor_pay_id = result['id']
+            content.append(subscription_message(due, result['id']))
+        else:
+            # webhooks refer to the invoice, see RazorpayEvent.payments
+            due.razor_pay_id = result['id']
+            content.append(invoice_message(due, result['short_url']))
+    db.session.commit()
+    RazorpayPlan.register(created)
+    if content:
+        sms.queue_sms(content)
+    # the outbox message is gone by now, failed dues are sent again from here
+    if failed:
+        retry_later(do_payments, attempt, failed)
+    return len(content)
+
+
+async def cancel_razorpay_invoices(session, invoice_ids):
+    return await asyncio.gather(*[session.razorpay('POST', '{0}/{1}/cancel'.format(URL.INVOICE_URL, invoice_id))
+                                  for invoice_id in invoice_ids], return_exceptions=True)
+
+
+@outbox.register_batchable
+@celery.task(name="celery.cancel_invoices")
+def cancel_invoices(invoice_ids, attempt=0):
+    # invoices replaced by an edited due, one paid before it is cancelled still settles it, see SupersededInvoice
+    failed = []
+    for invoice_id, result in zip(invoice_ids, async_http.run(cancel_razorpay_invoices, invoice_ids)):
+        # a bad request is an invoice that is already paid, cancelled or expired
+        if isinstance(result, Exception) and not isinstance(result, BadRequestError):
+            report_failure("Couldn't cancel razorpay invoice {0}".format(invoice_id), result)
+            failed.append(invoice_id)
+    if failed:
+        retry_later(cancel_invoices, attempt, failed)
+    return len(invoice_ids) - len(failed)
+
+
+@celery.task(name="celery.provision_customers")
+def provision_customers(owner_id, attempt=0):
+    # creates the razorpay customers an owner's billing run would need up front, a chunk at a time
+    chunk_size = current_app.config['RAZORPAY_PROVISION_CHUNK_SIZE']
+    query = User.query.options(load_only(User.id, User.first_name, User.mobile_number, User.razor_pay_id))\
+        .join(UserToUser, UserToUser.customer_id == User.id)\
+        .filter(UserToUser.business_owner_id == owner_id, User.razor_pay_id.is_(None)).order_by(User.id)
+    last_id, provisioned, failed = 0, 0, 0
+    while True:
+        customers = query.filter(User.id > last_id).limit(chunk_size).all()
+        if not customers:
+            break
+        created = len(async_http.run(create_customers, customers,
+                                     current_app.config['RAZORPAY_PROVISION_CONCURRENCY']))
         db.session.commit()
-        print(subscription)
-        token = subscription['id']
-        payment_url = f'http://localhost:8000/do_payment.html?token={token}'
-        print(payment_url)
-        content = [dict(message=f'Thank you for your interest in the service provided by'
-        f' {obj.creator.business_name}.Please complete your subscription and enjoy the service.'
-        f' Click to pay--> {payment_url}', to=[obj.customer.mobile_number])]
-        sms.send_sms(content=content)
-
-        #send_invoice.delay(, obj_id)
-
-    else:
-        inv = razorpay.invoice.create(data={
-            "customer": {
-                "name": obj.customer.first_name,
-                "email": "",
-                "contact": obj.customer.mobile_number
-            },
-            "type": "link",
-            "view_less": 1,
-            "amount": float(obj.amount) * 100,
-            "currency": "INR",
-            "description": obj.name,
-        })
-
-        context = { 
-            "inv_id": inv['id'],
-            "order_id": inv['order_id']
-        }
+        provisioned += created
+        failed += len(customers) - created
+        last_id = customers[-1].id
+    # each failure was reported by create_customers, the keyset has moved past them so another run picks them up
+    if failed:
+        retry_later(provision_customers, attempt, owner_id)
+    return provisioned
+
+
+@celery.task(name="celery.process_razorpay_events")
+def process_razorpay_events():
+    # drains the webhook queue a batch per transaction
+    batch_size = current_app.config['RAZORPAY_EVENT_BATCH_SIZE']
+    recorded = 0
+    while True:
+        connection = db.session.connection()
+        events = RazorpayEvent.claim(connection, batch_size)
+        try:
+            recorded += RazorpayEvent.process(connection, events)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            # one event that breaks the batch must not hold up the queue, go through it an event at a time
+            recorded += process_razorpay_events_one_by_one(events)
+        if len(events) < batch_size:
+            return recorded
+
+
+def process_razorpay_events_one_by_one(events):
+    recorded = 0
+    for event in events:
+        try:
+            recorded += RazorpayEvent.process(db.session.connection(), [event])
+            db.session.commit()
+        except DataError as e:
+            # the event itself can't be stored, retrying would fail the same way
+            sentry.captureException()
+            db.session.rollback()
+            RazorpayEvent.finish(db.session.connection(), [event.id], str(e.orig))
+            db.session.commit()
+        except Exception:
+            # a lost connection, a deadlock or a bug, the event stays pending for a later sweep
+            sentry.captureException()
+            db.session.rollback()
+            try:
+                RazorpayEvent.postpone(db.session.connection(), [event.id])
+                db.session.commit()
+            except SQLAlchemyError:
+                db.session.rollback()
+    return recorded
+
 
-        send_invoice.delay(inv, obj_id)
+@celery.task(name="celery.refresh_due_rollups")
+def refresh_due_rollups():
+    # re-read a window before the last sweep, updated_on is the transaction start so slow commits land late
+    last_sweep = redis_store.get('rollup:due:last_sweep')
+    since = datetime.fromisoformat(last_sweep.decode('utf-8')) if last_sweep else datetime.now() - timedelta(days=1)
+    since -= timedelta(seconds=current_app.config['DUE_ROLLUP_OVERLAP'])
+    swept_at, days = DueDailyRollup.sweep(since)
+    redis_store.set('rollup:due:last_sweep', swept_at.isoformat())
+    return days
@@ -1,9 +1,18 @@
-from flask_security import RoleMixin, UserMixin
-from sqlalchemy import UniqueConstraint, select, func, and_
-from sqlalchemy.dialects.postgresql import NUMERIC, ENUM
-from sqlalchemy.ext.hybrid import hybrid_property, hybrid_method
+import json
+from flask import current_app
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import UniqueConstraint, select, func, and_, or_, inspect, case, tuple_, union, true
+from sqlalchemy.dialects.postgresql import NUMERIC, ENUM, JSONB, insert
+from sqlalchemy.ext.hybrid import hybrid_property
+
+from src import db, ReprMixin, BaseMixin, redis_store
+from src.user.models import User, UserToUser
+from src.utils.resource import chunked
+
+REMINDER_BEFORE_DUE_DATE = 1
+REMINDER_ON_DUE_DATE = 2
 
-from src import db, ReprMixin, BaseMixin
 
 class Due(BaseMixin, ReprMixin, db.Model):
     __repr_fields__ = ['creator', 'customer']
@@ -24,20 +33,467 @@ class Due(BaseMixin, ReprMixin, db.Model):
 
     payments = db.relationship('Payment', uselist=True, lazy='dynamic', back_populates='due')
 
+    # set once when the first payment of a fixed due lands, see Due.mark_paid
+    paid_on = db.Column(db.TIMESTAMP(timezone=True), nullable=True)
+
+    # last subscription reminder claimed for this due, see Due.claim_reminders
+    reminder_stage = db.Column(db.SmallInteger, nullable=False, default=0, server_default='0')
+
+    __table_args__ = (
+        db.Index('ix_due_unpaid', creator_id, customer_id,
+                 postgresql_where=and_(paid_on.is_(None), is_cancelled.isnot(True))),
+        # DueDailyRollup.sweep finds the days to refresh through updated_on
+        db.Index('ix_due_updated_on', 'updated_on'),
+        db.Index('ix_due_reminder', due_date,
+                 postgresql_where=and_(transaction_type == 'subscription', is_cancelled.isnot(True),
+                                       reminder_stage < REMINDER_ON_DUE_DATE)),
+    )
+
     @hybrid_property
     def is_paid(self):
-        return self.transaction_type == 'fixed' and self.payments.first()
+        return self.paid_on is not None
 
     @is_paid.expression
-    def is_paid(self):
-        return select([func.count(Payment.id)])\
-                   .where(and_(self.transaction_type == 'fixed', Payment.due_id == self.id))\
-                   .limit(1).as_scalar() > 0
+    def is_paid(cls):
+        return cls.paid_on.isnot(None)
+
+    @classmethod
+    def mark_paid(cls, connection, due_ids, paid_on=None):
+        table = cls.__table__
+        settled = connection.execute(table.update()
+                                     .where(and_(table.c.id.in_(due_ids), table.c.paid_on.is_(None),
+                                                 table.c.transaction_type == 'fixed'))
+                                     .values(paid_on=paid_on or func.now())
+                                     .returning(table.c.creator_id, table.c.customer_id, table.c.amount,
+                                                table.c.is_cancelled)).fetchall()
+        balances = {}
+        for due in settled:
+            if not due.is_cancelled:
+                pair = (due.creator_id, due.customer_id)
+                balances[pair] = balances.get(pair, 0) + due.amount
+        for (creator_id, customer_id), amount in balances.items():
+            UserToUser.adjust_balance(connection, creator_id, customer_id, -amount)
+        return len(settled)
+
+    @classmethod
+    def reminder_window(cls, stage, grace_days=1):
+        today = func.current_date()
+        if stage == REMINDER_BEFORE_DUE_DATE:
+            return and_(cls.due_date > today, cls.due_date <= today + 3)
+        return and_(cls.due_date >= today - grace_days, cls.due_date <= today)
+
+    @classmethod
+    def claim_reminders(cls, connection, stage, limit=None, due_ids=None, grace_days=1):
+        # the stage is written before the sms goes out, so a retried or redelivered task can never send it twice
+        table = cls.__table__
+        claimable = select([table.c.id]).where(and_(cls.reminder_window(stage, grace_days),
+                                                    table.c.transaction_type == 'subscription',
+                                                    table.c.is_cancelled.isnot(True),
+                                                    table.c.reminder_stage < stage))
+        if due_ids is not None:
+            claimable = claimable.where(table.c.id.in_(due_ids))
+        claimable = claimable.order_by(table.c.id).limit(limit).with_for_update(skip_locked=True)
+        return [due_id for due_id, in connection.execute(table.update().where(table.c.id.in_(claimable))
+                                                         .values(reminder_stage=stage)
+                                                         .returning(table.c.id))]
+
+    @classmethod
+    def number_invoices(cls, connection, creator_id, due_ids):
+        # reserves the block and numbers the dues in id order in one statement
+        table = cls.__table__
+        block = User.invoice_number_block(creator_id, len(due_ids)).cte('block')
+        numbered = select([table.c.id, (block.c.counter - len(due_ids) + func.row_number().over(order_by=table.c.id))
+                          .label('invoice_num')]).where(table.c.id.in_(due_ids)).cte('numbered')
+        return dict(connection.execute(table.update().where(table.c.id == numbered.c.id)
+                                       .values(invoice_num=numbered.c.invoice_num,
+                                               due_date=case([(table.c.transaction_type == 'fixed', None)],
+                                                             else_=table.c.due_date))
+                                       .returning(table.c.id, table.c.invoice_num)).fetchall())
+
+    @classmethod
+    def apply_balances(cls, connection, due_ids):
+        # counterpart of the mapper events for dues written with Core inserts
+        totals = connection.execute(
+            select([cls.creator_id, cls.customer_id,
+                    func.sum(case([(and_(cls.transaction_type == 'fixed', cls.paid_on.is_(None),
+                                         cls.is_cancelled.isnot(True)), cls.amount)], else_=0)),
+                    func.count(case([(and_(cls.transaction_type == 'subscription',
+                                           cls.is_cancelled.isnot(True)), cls.id)]))])
+            .where(cls.id.in_(due_ids)).group_by(cls.creator_id, cls.customer_id)).fetchall()
+        for creator_id, customer_id, amount, subscriptions in totals:
+            UserToUser.adjust_balance(connection, creator_id, customer_id, amount, subscriptions)
+
+    @classmethod
+    def backfill_paid_on(cls, verify_only=False):
+        first_payment = select([func.min(Payment.created_on)]).where(Payment.due_id == cls.id).as_scalar()
+        unsynced = cls.query.filter(cls.paid_on.is_(None), cls.transaction_type == 'fixed',
+                                    cls.payments.any())
+        if verify_only:
+            return unsynced.count()
+        count = unsynced.update({cls.paid_on: first_payment}, synchronize_session=False)
+        db.session.commit()
+        return count
 
 
 class Payment(BaseMixin, ReprMixin, db.Model):
-    razor_pay_id = db.Column(db.String(20))
+    razor_pay_id = db.Column(db.String(20), unique=True)
 
     due_id = db.Column(db.ForeignKey('due.id'), nullable=False)
 
-    due = db.relationship('Due', uselist=False, foreign_keys=[due_id], back_populates='payments')
\ No newline at end of file
+    due = db.relationship('Due', uselist=False, foreign_keys=[due_id], back_populates='payments')
+
+    @classmethod
+    def record(cls, connection, payments):
+        # payments are (razorpay payment id, razorpay id of the subscription or invoice, unix time paid), each one
+        # is inserted once however often its events are delivered and only new ones settle their due. returns the
+        # number recorded and the subscription/invoice ids no due carries yet
+        payments = {payment_id: (due_ref, paid_at) for payment_id, due_ref, paid_at in payments}
+        due_refs = {due_ref for due_ref, _ in payments.values()}
+        if not payments:
+            return 0, set()
+        dues = dict(connection.execute(union(
+            select([Due.razor_pay_id, Due.id]).where(Due.razor_pay_id.in_(due_refs)),
+            select([SupersededInvoice.razor_pay_id, SupersededInvoice.due_id])
+            .where(SupersededInvoice.razor_pay_id.in_(due_refs)))).fetchall())
+        rows = [dict(razor_pay_id=payment_id, due_id=dues[due_ref],
+                     created_on=datetime.fromtimestamp(paid_at, timezone.utc) if paid_at else func.now())
+                for payment_id, (due_ref, paid_at) in payments.items() if due_ref in dues]
+        if not rows:
+            return 0, due_refs
+        table = cls.__table__
+        inserted = connection.execute(insert(table).values(rows)
+                                      .on_conflict_do_nothing(index_elements=['razor_pay_id'])
+                                      .returning(table.c.due_id)).fetchall()
+        Due.mark_paid(connection, list({due_id for due_id, in inserted}))
+        return len(inserted), due_refs - set(dues)
+
+
+class SupersededInvoice(BaseMixin, ReprMixin, db.Model):
+    __repr_fields__ = ['razor_pay_id', 'due_id']
+
+    # invoices replaced after their due was edited, one paid before razorpay cancels it still settles the due
+    razor_pay_id = db.Column(db.String(20), nullable=False, unique=True)
+    due_id = db.Column(db.ForeignKey('due.id', ondelete='CASCADE'), nullable=False, index=True)
+
+    @classmethod
+    def supersede(cls, connection, dues):
+        # dues are (due id, razorpay invoice id), returns the invoice ids to cancel
+        rows = [dict(razor_pay_id=invoice_id, due_id=due_id) for due_id, invoice_id in dues if invoice_id]
+        if rows:
+            connection.execute(insert(cls.__table__).values(rows)
+                               .on_conflict_do_nothing(index_elements=['razor_pay_id']))
+        return [row['razor_pay_id'] for row in rows]
+
+
+class RazorpayEvent(BaseMixin, ReprMixin, db.Model):
+    __repr_fields__ = ['id', 'event']
+
+    # x-razorpay-event-id, redelivered webhooks carry the same one
+    event_id = db.Column(db.String(64), nullable=False, unique=True)
+    event = db.Column(db.String(50), nullable=False)
+    payload = db.Column(JSONB, nullable=False)
+    processed_on = db.Column(db.TIMESTAMP(timezone=True), nullable=True)
+
+    # events whose due isn't known yet are retried after retry_after, until they give up with an error
+    attempts = db.Column(db.SmallInteger, nullable=False, server_default='0')
+    retry_after = db.Column(db.TIMESTAMP(timezone=True), nullable=True)
+    error = db.Column(db.String(100), nullable=True)
+
+    __table_args__ = (
+        db.Index('ix_razorpay_event_pending', 'id', postgresql_where=processed_on.is_(None)),
+    )
+
+    # subscription renewals also raise payment.captured and invoice.paid for an invoice carrying the
+    # subscription_id, no due carries that invoice and subscription.charged is the one that settles it
+    SETTLING = {'invoice.paid': 'invoice', 'subscription.charged': 'subscription'}
+
+    @classmethod
+    def append(cls, event_id, event, payload):
+        db.session.execute(insert(cls.__table__).values(event_id=event_id, event=event, payload=payload)
+                           .on_conflict_do_nothing(index_elements=['event_id']))
+        db.session.commit()
+
+    @classmethod
+    def claim(cls, connection, limit):
+        # locked until the consumer's transaction ends, concurrent consumers skip each other's rows
+        table = cls.__table__
+        return connection.execute(select([table.c.id, table.c.event, table.c.payload, table.c.attempts])
+                                  .where(and_(table.c.processed_on.is_(None),
+                                              or_(table.c.retry_after.is_(None), table.c.retry_after <= func.now())))
+                                  .order_by(table.c.id).limit(limit).with_for_update(skip_locked=True)).fetchall()
+
+    @classmethod
+    def payment(cls, event, payload):
+        # (payment id, razorpay id of the due, unix time paid) for settling events, None for the rest
+        if event not in cls.SETTLING:
+            return None
+        entities = {name: entity.get('entity', {}) for name, entity in payload.get('payload', {}).items()}
+        if event == 'invoice.paid' and entities.get('invoice', {}).get('subscription_id'):
+            return None
+        payment = entities.get('payment', {})
+        payment_id, due_ref, paid_at = payment.get('id'), entities.get(cls.SETTLING[event], {}).get('id'), \
+            payment.get('created_at')
+        for value in (payment_id, due_ref):
+            if not isinstance(value, str) or not 0 < len(value) <= 20:
+                raise ValueError('Malformed {0} event'.format(event))
+        if paid_at is not None and (not isinstance(paid_at, int) or isinstance(paid_at, bool)):
+            raise ValueError('Malformed {0} event'.format(event))
+        return payment_id, due_ref, paid_at
+
+    @classmethod
+    def finish(cls, connection, event_ids, error=None):
+        if event_ids:
+            table = cls.__table__
+            connection.execute(table.update().where(table.c.id.in_(event_ids))
+                               .values(processed_on=func.now(), error=error and error[:100]))
+
+    @classmethod
+    def postpone(cls, connection, event_ids):
+        if event_ids:
+            table = cls.__table__
+            connection.execute(table.update().where(table.c.id.in_(event_ids)).values(
+                attempts=table.c.attempts + 1,
+                retry_after=func.now() + timedelta(seconds=current_app.config['RAZORPAY_EVENT_RETRY_INTERVAL'])))
+
+    @classmethod
+    def process(cls, connection, events):
+        payments, invalid = {}, []
+        for event in events:
+            try:
+                payments[event.id] = cls.payment(event.event, event.payload)
+            except (ValueError, TypeError, AttributeError) as e:
+                invalid.append(event.id)
+                cls.finish(connection, [event.id], str(e))
+        recorded, unmatched = Payment.record(connection, [payment for payment in payments.values() if payment])
+
+        # a webhook can beat the commit that stores the due's razorpay id, unmatched events wait for it
+        retry, gave_up = [], []
+        for event in events:
+            payment = payments.get(event.id)
+            if payment and payment[1] in unmatched:
+                if event.attempts + 1 < current_app.config['RAZORPAY_EVENT_MAX_ATTEMPTS']:
+                    retry.append(event.id)
+                else:
+                    gave_up.append(event.id)
+        cls.postpone(connection, retry)
+        cls.finish(connection, gave_up, 'No due for the payment')
+        cls.finish(connection, [event.id for event in events
+                                if event.id not in invalid and event.id not in retry and event.id not in gave_up])
+        return recorded
+
+
+class RazorpayPlan(BaseMixin, ReprMixin, db.Model):
+    __repr_fields__ = ['id', 'creator_id', 'name', 'amount']
+
+    creator_id = db.Column(db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
+    name = db.Column(db.String(20), nullable=False)
+    amount = db.Column(NUMERIC(8, 2), nullable=False)
+    period = db.Column(db.String(10), nullable=False, server_default='monthly')
+    interval = db.Column(db.SmallInteger, nullable=False, server_default='1')
+    razor_pay_id = db.Column(db.String(20), nullable=False)
+
+    UniqueConstraint(creator_id, name, amount, period, interval)
+
+    # every due creates a plan with these, see plan_data
+    PERIOD = 'monthly'
+    INTERVAL = 1
+
+    @classmethod
+    def key(cls, due):
+        return due.creator_id, due.name, '{0:.2f}'.format(due.amount), cls.PERIOD, cls.INTERVAL
+
+    @staticmethod
+    def cache_key(key):
+        return 'razorpay:plan:' + json.dumps(key, separators=(',', ':'))
+
+    @classmethod
+    def lookup(cls, keys):
+        # redis first, the table for misses, whatever the table had is cached for the next batch
+        keys = list(set(keys))
+        if not keys:
+            return {}
+        plans = {key: plan_id.decode('utf-8') for key, plan_id in
+                 zip(keys, redis_store.mget([cls.cache_key(key) for key in keys])) if plan_id is not None}
+        missing = [key for key in keys if key not in plans]
+        if missing:
+            found = {}
+            for chunk in chunked(missing, 500):
+                found.update(((creator_id, name, '{0:.2f}'.format(amount), period, interval), plan_id)
+                             for creator_id, name, amount, period, interval, plan_id in db.session.query(
+                                 cls.creator_id, cls.name, cls.amount, cls.period, cls.interval, cls.razor_pay_id)
+                             .filter(tuple_(cls.creator_id, cls.name, cls.amount, cls.period, cls.interval).in_(chunk)))
+            cls.cache(found)
+            plans.update(found)
+        return plans
+
+    @classmethod
+    def register(cls, plans):
+        # plans created by concurrent batches race on the unique key, the first one stays registered and the
+        # other is only used by the subscriptions already made with it
+        if not plans:
+            return {}
+        stmt = insert(cls.__table__).values([
+            dict(creator_id=creator_id, name=name, amount=amount, period=period, interval=interval,
+                 razor_pay_id=plan_id) for (creator_id, name, amount, period, interval), plan_id in plans.items()])
+        stmt = stmt.on_conflict_do_nothing(index_elements=['creator_id', 'name', 'amount', 'period', 'interval'])
+        inserted = db.session.execute(stmt.returning(cls.creator_id, cls.name, cls.amount, cls.period, cls.interval,
+                                                     cls.razor_pay_id)).fetchall()
+        db.session.commit()
+        registered = {(creator_id, name, '{0:.2f}'.format(amount), period, interval): plan_id
+                      for creator_id, name, amount, period, interval, plan_id in inserted}
+        cls.cache(registered)
+        return registered
+
+    @classmethod
+    def cache(cls, plans):
+        if plans:
+            pipe = redis_store.pipeline()
+            for key, plan_id in plans.items():
+                pipe.set(cls.cache_key(key), plan_id, ex=current_app.config['RAZORPAY_PLAN_CACHE_TIMEOUT'])
+            pipe.execute()
+
+
+class DueDailyRollup(ReprMixin, db.Model):
+    __tablename__ = 'due_daily_rollup'
+    __repr_fields__ = ['creator_id', 'day', 'transaction_type']
+
+    creator_id = db.Column(db.ForeignKey('user.id', ondelete='CASCADE'), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    transaction_type = db.Column(ENUM('fixed', 'subscription', name='varchar', create_type=False), primary_key=True)
+
+    # dues created on `day`, and how many of those are paid or cancelled by now
+    dues = db.Column(db.Integer, nullable=False, server_default='0')
+    amount = db.Column(NUMERIC(12, 2), nullable=False, server_default='0')
+    paid = db.Column(db.Integer, nullable=False, server_default='0')
+    paid_amount = db.Column(NUMERIC(12, 2), nullable=False, server_default='0')
+    cancelled = db.Column(db.Integer, nullable=False, server_default='0')
+    cancelled_amount = db.Column(NUMERIC(12, 2), nullable=False, server_default='0')
+
+    # dues whose first payment landed on `day`, whenever they were created
+    collected = db.Column(db.Integer, nullable=False, server_default='0')
+    collected_amount = db.Column(NUMERIC(12, 2), nullable=False, server_default='0')
+
+    # only written by upsert, which sets it itself
+    updated_on = db.Column(db.TIMESTAMP(timezone=True), server_default=func.now())
+
+    @classmethod
+    def upsert(cls, connection, query, columns):
+        stmt = insert(cls.__table__).from_select(['creator_id', 'day', 'transaction_type'] + columns, query)
+        connection.execute(stmt.on_conflict_do_update(
+            index_elements=['creator_id', 'day', 'transaction_type'],
+            set_=dict({column: getattr(stmt.excluded, column) for column in columns}, updated_on=func.now())))
+
+    @classmethod
+    def aggregate(cls, connection, created=None, collected=None):
+        live = Due.is_cancelled.isnot(True)
+        day = func.date(Due.created_on)
+        cls.upsert(connection, select([
+            Due.creator_id, day, Due.transaction_type,
+            func.count(case([(live, Due.id)])),
+            func.coalesce(func.sum(case([(live, Due.amount)])), 0),
+            func.count(case([(and_(live, Due.paid_on.isnot(None)), Due.id)])),
+            func.coalesce(func.sum(case([(and_(live, Due.paid_on.isnot(None)), Due.amount)])), 0),
+            func.count(case([(Due.is_cancelled.is_(True), Due.id)])),
+            func.coalesce(func.sum(case([(Due.is_cancelled.is_(True), Due.amount)])), 0)])
+            .where(created if created is not None else true())
+            .group_by(Due.creator_id, day, Due.transaction_type),
+            ['dues', 'amount', 'paid', 'paid_amount', 'cancelled', 'cancelled_amount'])
+
+        day = func.date(Due.paid_on)
+        cls.upsert(connection, select([
+            Due.creator_id, day, Due.transaction_type, func.count(Due.id), func.sum(Due.amount)])
+            .where(and_(Due.paid_on.isnot(None), Due.is_cancelled.isnot(True),
+                        collected if collected is not None else true()))
+            .group_by(Due.creator_id, day, Due.transaction_type),
+            ['collected', 'collected_amount'])
+
+    @classmethod
+    def refresh(cls, connection, keys, chunk_size=500):
+        # recompute whole (creator_id, day) rows from due, deleting first so rows that no longer have dues go away
+        table = cls.__table__
+        for chunk in chunked(sorted(keys), chunk_size):
+            connection.execute(table.delete().where(tuple_(table.c.creator_id, table.c.day).in_(chunk)))
+            cls.aggregate(connection,
+                          created=or_(*[and_(Due.creator_id == creator_id, Due.created_on >= day,
+                                             Due.created_on < day + timedelta(days=1)) for creator_id, day in chunk]),
+                          collected=or_(*[and_(Due.creator_id == creator_id, Due.paid_on >= day,
+                                               Due.paid_on < day + timedelta(days=1)) for creator_id, day in chunk]))
+
+    @classmethod
+    def sweep(cls, since):
+        connection = db.session.connection()
+        now = connection.execute(select([func.now()])).scalar()
+        changed = Due.updated_on >= since
+        keys = connection.execute(union(
+            select([Due.creator_id, func.date(Due.created_on)]).where(changed),
+            select([Due.creator_id, func.date(Due.paid_on)]).where(and_(changed, Due.paid_on.isnot(None))))
+        ).fetchall()
+        cls.refresh(connection, {tuple(key) for key in keys})
+        db.session.commit()
+        return now, len(keys)
+
+    @classmethod
+    def rebuild(cls, creator_id=None):
+        connection = db.session.connection()
+        table = cls.__table__
+        if creator_id is None:
+            connection.execute(table.delete())
+            cls.aggregate(connection)
+        else:
+            connection.execute(table.delete().where(table.c.creator_id == creator_id))
+            cls.aggregate(connection, created=Due.creator_id == creator_id, collected=Due.creator_id == creator_id)
+        db.session.commit()
+
+
+def due_balance(transaction_type, amount, is_cancelled, is_paid):
+    # (outstanding amount, active subscriptions) a due contributes to its owner/customer pair
+    if is_cancelled:
+        return 0, 0
+    if transaction_type == 'subscription':
+        return 0, 1
+    return (0 if is_paid else amount or 0), 0
+
+
+def previous_value(state, key):
+    history = state.attrs[key].history
+    return history.deleted[0] if history.deleted else getattr(state.object, key)
+
+
+@db.event.listens_for(Due, 'after_insert')
+def due_inserted(mapper, connection, target):
+    amount, subscriptions = due_balance(target.transaction_type, target.amount, target.is_cancelled,
+                                        target.is_paid)
+    UserToUser.adjust_balance(connection, target.creator_id, target.customer_id, amount, subscriptions)
+
+
+BALANCE_KEYS = ('creator_id', 'customer_id', 'transaction_type', 'amount', 'is_cancelled', 'paid_on')
+
+
+def load_previous_value(target, value, oldvalue, initiator):
+    pass
+
+
+# due_updated needs the value a column had before the update, active history loads it first when the column is set
+# on an expired instance, a rolled back savepoint expires them
+for key in BALANCE_KEYS:
+    db.event.listen(getattr(Due, key), 'set', load_previous_value, active_history=True)
+
+
+@db.event.listens_for(Due, 'after_update')
+def due_updated(mapper, connection, target):
+    state = inspect(target)
+    if not any(state.attrs[key].history.has_changes() for key in BALANCE_KEYS):
+        return
+    old = {key: previous_value(state, key) for key in BALANCE_KEYS}
+
+    amount, subscriptions = due_balance(old['transaction_type'], old['amount'], old['is_cancelled'],
+                                        old['paid_on'] is not None)
+    UserToUser.adjust_balance(connection, old['creator_id'], old['customer_id'], -amount, -subscriptions)
+    amount, subscriptions = due_balance(target.transaction_type, target.amount, target.is_cancelled,
+                                        target.is_paid)
+    UserToUser.adjust_balance(connection, target.creator_id, target.customer_id, amount, subscriptions)
+
+
+@db.event.listens_for(Payment, 'after_insert')
+def payment_inserted(mapper, connection, target):
+    Due.mark_paid(connection, [target.due_id])
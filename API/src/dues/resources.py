@@ -1,12 +1,14 @@
 from flask_security import current_user
 from sqlalchemy import and_
+from sqlalchemy.orm.attributes import set_committed_value
 
-from src import db
-from src.user.models import UserToUser
+from src import db, outbox
+from src.user.models import UserToUser, customer_cache
 from src.utils import ModelResource, operators as ops
+from .models import SupersededInvoice
 from .schemas import Due, DueSchema, Payment, PaymentSchema
 
-from src.dues.celerytasks import sms_on_due_date, sms_before_3_days, send_invoice, do_payment
+from src.dues.celerytasks import cancel_invoices, do_payments
 
 class DueResource(ModelResource):
     model = Due
@@ -32,19 +34,45 @@ class DueResource(ModelResource):
 
     order_by = ['created_on', 'id', 'due_date']
 
+    tracked_fields = ('amount', 'customer_id')
+
+    group_by = ('transaction_type', 'customer_id', 'creator_id', 'is_cancelled', 'created_on', 'due_date',
+                'paid_on')
+
+    aggregate_fields = ('amount', 'months')
+
     only = ()
 
+    field_dependencies = {
+        'is_paid': ('paid_on',),
+    }
+
     def has_read_permission(self, qs):
         return qs.filter(Due.creator_id == current_user.id)
 
+    def get_customer_ids(self, customer_ids):
+        customer_ids = set(customer_ids)
+        allowed = customer_ids & customer_cache.get(current_user.id)
+        unknown = customer_ids - allowed
+        if unknown:
+            # the cached set may predate a newly verified customer, confirm misses in one IN query
+            with db.session.no_autoflush:
+                verified = {customer_id for customer_id, in db.session.query(UserToUser.customer_id)
+                            .filter(UserToUser.business_owner_id == current_user.id,
+                                    UserToUser.customer_id.in_(unknown))}
+            if verified:
+                customer_cache.invalidate(current_user.id)
+            allowed |= verified
+        return allowed
+
     def has_change_permission(self, obj):
+        return self.has_bulk_change_permission([obj])
 
-        if obj.creator_id == current_user.id and \
-                db.session.query(UserToUser.query.filter(UserToUser.business_owner_id == current_user,
-                                                         UserToUser.customer_id == obj.customer_id).exists()) \
-                        .scalar():
-            return True
-        return False
+    def has_bulk_change_permission(self, objects):
+        if any(obj.creator_id != current_user.id for obj in objects):
+            return False
+        customer_ids = {obj.customer_id for obj in objects}
+        return self.get_customer_ids(customer_ids) == customer_ids
 
     def has_delete_permission(self, obj):
         return False
@@ -52,31 +80,47 @@ class DueResource(ModelResource):
     def has_add_permission(self, objects):
         for obj in objects:
             obj.creator_id = current_user.id
-            if not db.session.query(UserToUser.query.filter(UserToUser.business_owner_id == current_user.id,
-                                                            UserToUser.customer_id == obj.customer_id).exists()) \
-                    .scalar():
-                return False
-        return True
-
-    def after_objects_save(self, objects):
+        customer_ids = {obj.customer_id for obj in objects}
+        return self.get_customer_ids(customer_ids) == customer_ids
+
+    def before_bulk_commit(self, ids):
+        connection = db.session.connection()
+        Due.apply_balances(connection, ids)
+        Due.number_invoices(connection, current_user.id, ids)
+        db.session.expire(current_user._get_current_object(), ['counter'])
+        outbox.enqueue(do_payments, ids)
+
+    def after_bulk_save(self, ids):
+        pass
+
+    def before_objects_commit(self, objects):
+        numbers = Due.number_invoices(db.session.connection(), current_user.id, [obj.id for obj in objects])
+        db.session.expire(current_user._get_current_object(), ['counter'])
+        # already written by number_invoices, only the loaded state is brought in line
         for obj in objects:
-            current_user.counter += 1
-            obj.invoice_num = current_user.counter
-
-            # Celery tasks executions
-            try:
-                do_payment.delay(obj.id)
-                if obj.transaction_type == 'subscription':
-                    from datetime import timedelta
-                    sms_before_3_days.apply_async(args=[obj.id], eta=obj.due_date-timedelta(days=3))
-                    sms_on_due_date.apply_async(args=[obj.id], eta=obj.due_date)
-                elif obj.transaction_type == 'fixed':
-                    obj.due_date = None 
-
-            except Exception as e:
-                print("Couldn't complete transaction:", e)
-
-            db.session.commit()
+            set_committed_value(obj, 'invoice_num', numbers[obj.id])
+            if obj.transaction_type == 'fixed':
+                set_committed_value(obj, 'due_date', None)
+
+        # razorpay links are created by the outbox relay once this transaction commits
+        outbox.enqueue(do_payments, [obj.id for obj in objects])
+
+    def before_update_commit(self, objects, changes):
+        # an open invoice whose amount or customer changed is numbered and sent again, the one sent before is
+        # cancelled at razorpay. subscriptions keep theirs, a new one would charge the customer twice. dues whose
+        # link was never created get another try on any edit
+        objects = [obj for obj, changed in zip(objects, changes) if not obj.is_paid and not obj.is_cancelled and
+                   (obj.razor_pay_id is None or obj.transaction_type == 'fixed' and changed)]
+        if objects:
+            connection = db.session.connection()
+            superseded = SupersededInvoice.supersede(connection, [(obj.id, obj.razor_pay_id) for obj in objects])
+            Due.query.filter(Due.id.in_([obj.id for obj in objects]))\
+                .update({Due.razor_pay_id: None}, synchronize_session=False)
+            for obj in objects:
+                set_committed_value(obj, 'razor_pay_id', None)
+            self.before_objects_commit(objects)
+            if superseded:
+                outbox.enqueue(cancel_invoices, superseded)
 
 
 class PaymentResource(ModelResource):
@@ -96,6 +140,8 @@ class PaymentResource(ModelResource):
 
     order_by = ['created_on', 'id', 'due_id']
 
+    group_by = ('due_id', 'created_on')
+
     only = ()
 
     def has_read_permission(self, qs):
@@ -11,6 +11,8 @@ class DueSchema(BaseSchema):
     amount = ma.Integer(required=True)
     transaction_type = ma.String(required=True)
     due_date = ma.Date(required=False)
+    is_paid = ma.Boolean(dump_only=True)
+    paid_on = ma.DateTime(dump_only=True)
 
     customer_id = ma.Integer(load_only=True, allow_one=False)
 
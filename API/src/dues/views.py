@@ -1,6 +1,13 @@
-from src import BaseView
+import hashlib
+
+from flask import request, jsonify, make_response, current_app
+from flask_restful import Resource
+from razorpay.errors import SignatureVerificationError
+
+from src import BaseView, razor
 from src import api
 from src.utils.methods import List, Fetch, Create, Update
+from .models import RazorpayEvent
 from .resources import DueResource, PaymentResource
 
 @api.register()
@@ -19,3 +26,27 @@ class PaymentView(BaseView):
     @classmethod
     def get_resource(cls):
         return PaymentResource
+
+
+class RazorpayWebhookResource(Resource):
+
+    def post(self):
+        # only verified and queued here, celery.process_razorpay_events records the payments
+        secret = current_app.config.get('RAZOR_PAY_WEBHOOK_SECRET')
+        if not secret:
+            # an empty key would make every signature forgeable
+            return make_response(jsonify({'error': True, 'message': 'Webhook not configured'}), 503)
+        body = request.get_data(as_text=True)
+        try:
+            razor.utility.verify_webhook_signature(body, request.headers.get('X-Razorpay-Signature', ''), secret)
+        except SignatureVerificationError:
+            return make_response(jsonify({'error': True, 'message': 'Invalid signature'}), 400)
+        payload = request.get_json(force=True, silent=True)
+        if not payload or not payload.get('event'):
+            return make_response(jsonify({'error': True, 'message': 'Invalid event'}), 400)
+        event_id = request.headers.get('X-Razorpay-Event-Id') or hashlib.sha1(body.encode('utf-8')).hexdigest()
+        RazorpayEvent.append(event_id, payload['event'], payload)
+        return make_response(jsonify({'success': True}), 200)
+
+
+api.add_resource(RazorpayWebhookResource, '/razorpay/webhook/', endpoint='razorpay_webhook')
@@ -1,11 +1,13 @@
-from flask import request
 from flask_security import current_user
-from sqlalchemy import and_
+from sqlalchemy import func, case, and_, cast
+from sqlalchemy.dialects.postgresql import TIMESTAMP
 
+from src.dues.models import Due, DueDailyRollup
 from src.utils import DataResource, operators as ops
 
 
 class ReportResource(DataResource):
+    model = Due
 
     max_limit: int = 1000
 
@@ -21,8 +23,54 @@ class ReportResource(DataResource):
 
     roles_accepted = ('admin', 'owner', 'manager', 'order_taker')
 
-    headers = [('parent_category_name', 'name', 'quantity', 'rate', 'net_price', 'discount', 'total_tax',
-                'gross_price', 'outlet')]
+    date_column = 'created_on'
 
-    def construct_query_set(self):
-        return self.model.query
\ No newline at end of file
+    filters = {
+        'customer_id': [ops.Equal, ops.In],
+        'transaction_type': [ops.Equal, ops.In],
+        'is_cancelled': [ops.Boolean],
+    }
+
+    dimensions = {
+        'day': func.date_trunc('day', Due.created_on),
+        'week': func.date_trunc('week', Due.created_on),
+        'month': func.date_trunc('month', Due.created_on),
+        'transaction_type': Due.transaction_type,
+        'customer_id': Due.customer_id,
+    }
+
+    measures = {
+        'dues': func.count(case([(Due.is_cancelled.isnot(True), Due.id)])),
+        'amount': func.coalesce(func.sum(case([(Due.is_cancelled.isnot(True), Due.amount)])), 0),
+        'paid_amount': func.coalesce(func.sum(case([(and_(Due.is_cancelled.isnot(True), Due.paid_on.isnot(None)),
+                                                     Due.amount)])), 0),
+        'cancelled': func.count(case([(Due.is_cancelled.is_(True), Due.id)])),
+    }
+
+    rollup = DueDailyRollup
+
+    rollup_date_column = 'day'
+
+    rollup_dimensions = {
+        'day': func.date_trunc('day', cast(DueDailyRollup.day, TIMESTAMP(timezone=True))),
+        'week': func.date_trunc('week', cast(DueDailyRollup.day, TIMESTAMP(timezone=True))),
+        'month': func.date_trunc('month', cast(DueDailyRollup.day, TIMESTAMP(timezone=True))),
+        'transaction_type': DueDailyRollup.transaction_type,
+    }
+
+    rollup_measures = {
+        'dues': func.coalesce(func.sum(DueDailyRollup.dues), 0),
+        'amount': func.coalesce(func.sum(DueDailyRollup.amount), 0),
+        'paid_amount': func.coalesce(func.sum(DueDailyRollup.paid_amount), 0),
+        'cancelled': func.coalesce(func.sum(DueDailyRollup.cancelled), 0),
+    }
+
+    rollup_filters = ('transaction_type',)
+
+    group_by = ('day', 'transaction_type')
+
+    headers = ('day', 'week', 'month', 'customer_id', 'transaction_type', 'dues', 'amount', 'paid_amount',
+               'cancelled')
+
+    def has_read_permission(self, qs):
+        return qs.filter(self.source.creator_id == current_user.id)
@@ -1,15 +1,9 @@
-from flask import request, make_response, jsonify
-
-from src import DataView, api, db
+from src import DataView, api
 from .resources import ReportResource
 
 
-# @api.register()
+@api.register(name='report')
 class ReportView(DataView):
     @classmethod
     def get_resource(cls):
         return ReportResource
-
-    def get(self, slug=None):
-        return make_response(jsonify(), 200)
-
@@ -1,9 +1,12 @@
 from flask_login import current_user
 from flask_security import RoleMixin, UserMixin
-from sqlalchemy import UniqueConstraint, func
-from sqlalchemy.ext.hybrid import hybrid_property, hybrid_method
+from sqlalchemy import UniqueConstraint, func, select, and_, or_
+from sqlalchemy.dialects.postgresql import NUMERIC
+from sqlalchemy.orm import query_expression
+from sqlalchemy.ext.hybrid import hybrid_property
 
 from src import db, ReprMixin, BaseMixin
+from src.utils.cache import SetCache
 from datetime import datetime
 
 
@@ -49,25 +52,116 @@ class User(BaseMixin, ReprMixin, UserMixin, db.Model):
 
     roles = db.relationship('Role', back_populates='users', secondary='user_role')
 
+    # filled in by list queries through with_expression() so the hybrids below need no per-row query
+    fixed_dues_total = query_expression()
+    subscription_count = query_expression()
+
+    @classmethod
+    def invoice_number_block(cls, user_id, count):
+        # atomic increment, concurrent creates by the same owner queue on the row lock instead of reusing numbers
+        table = cls.__table__
+        return table.update().where(table.c.id == user_id) \
+            .values(counter=func.coalesce(table.c.counter, 0) + count).returning(table.c.counter)
+
+    @classmethod
+    def fixed_dues_query(cls, creator_id):
+        from src.dues.models import Due
+        return select([func.coalesce(func.sum(Due.amount), 0)])\
+            .where(and_(Due.customer_id == cls.id, Due.creator_id == creator_id, Due.is_paid.isnot(True),
+                        Due.is_cancelled.isnot(True), Due.transaction_type == 'fixed')).as_scalar()
+
+    @classmethod
+    def subscriptions_query(cls, creator_id):
+        from src.dues.models import Due
+        return select([func.count(Due.id)])\
+            .where(and_(Due.customer_id == cls.id, Due.creator_id == creator_id, Due.is_cancelled.isnot(True),
+                        Due.transaction_type == 'subscription')).as_scalar()
+
     @hybrid_property
     def fixed_dues(self):
-        from src.dues.models import Due
-        return Due.query.with_entities(Due.amount)\
-            .filter(Due.is_paid.isnot(True), Due.creator.creator_id == current_user.id, Due.is_cancelled.isnot(True),
-                    Due.transaction_type == 'fixed',
-                    Due.customer_id == self.id).limit(1).scalar()
+        if self.fixed_dues_total is not None:
+            return self.fixed_dues_total
+        return db.session.query(User.fixed_dues_query(current_user.id)).filter(User.id == self.id).scalar()
+
+    @fixed_dues.expression
+    def fixed_dues(cls):
+        return cls.fixed_dues_query(current_user.id)
 
     @hybrid_property
     def subscriptions(self):
-        from src.dues.models import Due
-        return Due.query.with_entities(func.count(Due.id)) \
-            .filter(Due.creator_id == current_user.id, Due.is_cancelled.isnot(True),
-                    Due.transaction_type == 'subscription',
-                    Due.customer_id == self.id).limit(1).scalar()
+        if self.subscription_count is not None:
+            return self.subscription_count
+        return db.session.query(User.subscriptions_query(current_user.id)).filter(User.id == self.id).scalar()
+
+    @subscriptions.expression
+    def subscriptions(cls):
+        return cls.subscriptions_query(current_user.id)
 
 
 class UserToUser(BaseMixin, ReprMixin, db.Model):
     business_owner_id = db.Column(db.ForeignKey('user.id'), nullable=False)
     customer_id = db.Column(db.ForeignKey('user.id'), nullable=False)
 
+    # maintained by the Due/Payment write hooks in src.dues.models, repaired by `manager.py rebuild_balances`
+    outstanding_amount = db.Column(NUMERIC(10, 2), nullable=False, default=0, server_default='0')
+    active_subscriptions = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
     UniqueConstraint(business_owner_id, customer_id)
+
+    @classmethod
+    def adjust_balance(cls, connection, business_owner_id, customer_id, amount=0, subscriptions=0):
+        if not amount and not subscriptions:
+            return
+        table = cls.__table__
+        connection.execute(table.update()
+                           .where(and_(table.c.business_owner_id == business_owner_id,
+                                       table.c.customer_id == customer_id))
+                           .values(outstanding_amount=table.c.outstanding_amount + amount,
+                                   active_subscriptions=table.c.active_subscriptions + subscriptions))
+
+    @classmethod
+    def outstanding_query(cls, business_owner_id):
+        return select([func.coalesce(func.max(cls.outstanding_amount), 0)])\
+            .where(and_(cls.business_owner_id == business_owner_id, cls.customer_id == User.id)).as_scalar()
+
+    @classmethod
+    def subscriptions_query(cls, business_owner_id):
+        return select([func.coalesce(func.max(cls.active_subscriptions), 0)])\
+            .where(and_(cls.business_owner_id == business_owner_id, cls.customer_id == User.id)).as_scalar()
+
+    @classmethod
+    def balance_expressions(cls):
+        from src.dues.models import Due
+        pair = and_(Due.creator_id == cls.business_owner_id, Due.customer_id == cls.customer_id,
+                    Due.is_cancelled.isnot(True))
+        outstanding = select([func.coalesce(func.sum(Due.amount), 0)])\
+            .where(and_(pair, Due.transaction_type == 'fixed', Due.is_paid.isnot(True))).as_scalar()
+        subscriptions = select([func.count(Due.id)])\
+            .where(and_(pair, Due.transaction_type == 'subscription')).as_scalar()
+        return outstanding, subscriptions
+
+    @classmethod
+    def rebuild_balances(cls, business_owner_id=None, verify_only=False):
+        outstanding, subscriptions = cls.balance_expressions()
+        drifted = db.session.query(cls.id, cls.business_owner_id, cls.customer_id,
+                                   cls.outstanding_amount, outstanding.label('expected_amount'),
+                                   cls.active_subscriptions, subscriptions.label('expected_subscriptions'))\
+            .filter(or_(cls.outstanding_amount != outstanding, cls.active_subscriptions != subscriptions))
+        if business_owner_id is not None:
+            drifted = drifted.filter(cls.business_owner_id == business_owner_id)
+        drifted = drifted.all()
+        if drifted and not verify_only:
+            db.session.query(cls).filter(cls.id.in_([row.id for row in drifted]))\
+                .update({cls.outstanding_amount: outstanding, cls.active_subscriptions: subscriptions},
+                        synchronize_session=False)
+            db.session.commit()
+        return drifted
+
+
+def load_customer_ids(business_owner_id):
+    return [customer_id for customer_id, in db.session.query(UserToUser.customer_id)
+            .filter(UserToUser.business_owner_id == business_owner_id)]
+
+
+# business owner id -> ids of their verified customers, invalidated whenever a UserToUser row is created
+customer_cache = SetCache('customers', load_customer_ids, config_prefix='CUSTOMER_CACHE')
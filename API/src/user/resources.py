@@ -1,5 +1,6 @@
 from flask_security import current_user
 from sqlalchemy import and_, or_
+from sqlalchemy.orm import with_expression
 
 from src.user.models import UserToUser
 from src.utils import ModelResource, operators as ops
@@ -33,6 +34,11 @@ class UserResource(ModelResource):
 
     }
 
+    field_dependencies = {
+        'fixed_dues': ('id',),
+        'subscriptions': ('id',),
+    }
+
     order_by = ['email', 'id', 'name']
 
     only = ()
@@ -40,6 +46,16 @@ class UserResource(ModelResource):
     def has_read_permission(self, qs):
         return qs.filter(User.id == current_user.id)
 
+    def apply_expressions(self, queryset, schema):
+        # served from the counters kept on user_to_user rather than aggregating dues per customer
+        if 'fixed_dues' in schema.fields:
+            queryset = queryset.options(with_expression(User.fixed_dues_total,
+                                                        UserToUser.outstanding_query(current_user.id)))
+        if 'subscriptions' in schema.fields:
+            queryset = queryset.options(with_expression(User.subscription_count,
+                                                        UserToUser.subscriptions_query(current_user.id)))
+        return queryset
+
     def has_change_permission(self, obj):
         if current_user.has_role('admin') or current_user.has_role('owner'):
             if current_user.brand_id == obj.brand_id:
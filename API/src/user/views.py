@@ -12,7 +12,7 @@ from src import api
 from src.user.schemas import UserSchema
 from src.utils.api import set_user
 from src.utils.methods import List, Fetch, Create, Update
-from .models import User, UserToUser
+from .models import User, UserToUser, customer_cache
 from .resources import UserResource
 
 
@@ -147,11 +147,13 @@ class CustomerVerifyResource(Resource):
         user = self.model.query.filter(self.model.mobile_number == data['mobile_number']).first()
         if user and redis_store.get(data['mobile_number']).decode('utf-8') == data['otp']:
 
-            utu = UserToUser()
-            utu.business_owner_id = current_user.id
-            utu.customer_id = user.id
-            db.session.add(utu)
-            db.session.commit()
+            if user.id not in customer_cache.get(current_user.id):
+                utu = UserToUser()
+                utu.business_owner_id = current_user.id
+                utu.customer_id = user.id
+                db.session.add(utu)
+                db.session.commit()
+                customer_cache.invalidate(current_user.id)
             return make_response(jsonify({'id': user.id, 'first_name': user.first_name}), 200)
         else:
             return make_response(jsonify({'meta': {'code': 403}}), 403)
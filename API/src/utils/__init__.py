@@ -14,5 +14,8 @@ from .url_shortener import url_shortener
 from .limiter import limiter
 from .jwt import jwt
 from .razorpay import razor
+from .http_pool import http_pool
+from .async_http import async_http
+from .outbox import outbox
 
 
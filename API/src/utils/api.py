@@ -5,18 +5,20 @@ from functools import wraps
 
 from flask_restful import Api
 from flask_restful import Resource
-from flask import request, jsonify, make_response
+from flask import request, jsonify, make_response, send_file
 from flask_security.decorators import _security, current_app, \
     _request_ctx_stack, identity_changed, Identity, _get_unauthorized_response
 from flask_jwt_extended import jwt_required, get_jwt_identity
 
 
 from flask_excel import make_response_from_records
-from flask_security import roles_required, roles_accepted
+from flask_security import roles_required, roles_accepted, current_user
 from sqlalchemy.exc import DataError
 
 from .models import db
 from .blue_prints import bp
+from .export import make_csv_response, start_export, get_export_job, export_job_response, export_file_path, \
+    get_export_file_type
 from .resource import ModelResource, AssociationModelResource, DataResource
 from .exceptions import ResourceNotFound, SQLIntegrityError, SQlOperationalError, CustomException, \
     SQlInvalidRequestError, SQLDetachedInstanceError
@@ -108,16 +110,12 @@ class BaseView(Resource):
 
     def get(self, slug=None):
         if slug:
+            schema = self.resource.get_schema()
             obj = self.resource.model.query.filter(self.resource.model.id == slug)
-            obj = self.resource.has_read_permission(obj).first()
+            obj = self.resource.has_read_permission(obj)
+            obj = self.resource.apply_loading(obj, schema).first()
             if obj:
-                schema = self.resource.schema
-                if self.resource.only:
-                    data = schema(exclude=tuple(self.resource.obj_exclude), only=tuple(self.resource.obj_only))
-                else:
-                    data = schema(exclude=tuple(self.resource.obj_exclude))
-
-                return make_response(jsonify(data.dump(obj, many=False).data), 200)
+                return make_response(jsonify(schema.dump(obj, many=False).data), 200)
 
             return make_response(jsonify({'error': True, 'message': 'Resource not found'}), 404)
 
@@ -125,33 +123,92 @@ class BaseView(Resource):
             objects = self.resource.apply_filters(queryset=self.resource.model.query, **request.args)
             objects = self.resource.has_read_permission(objects)
 
+            if '__group_by' in request.args or '__aggregate' in request.args:
+                return self.get_aggregate_page(objects)
+
+            if self.resource.cursor:
+                return self.get_keyset_page(objects)
+
             if '__order_by' in request.args:
                 objects = self.resource.apply_ordering(objects, request.args.getlist('__order_by'))
 
+            schema = self.resource.get_schema()
+            objects = self.resource.apply_loading(objects, schema)
+
             if '__export__' in request.args and self.resource.export is True:
+                try:
+                    file_type = get_export_file_type()
+                except CustomException as e:
+                    e.message['error'] = True
+                    return make_response(jsonify(e.message), e.status)
+                if '__async' in request.args:
+                    return make_response(jsonify(start_export(self.resource, file_type)), 202)
+                if file_type == 'csv':
+                    return make_csv_response(self.resource.export_rows(objects, schema),
+                                             self.resource.model.__name__)
+                # spreadsheet writers need the whole sheet in memory, so these stay capped
                 objects = objects.paginate(page=self.resource.page, per_page=self.resource.max_export_limit)
-                return make_response_from_records(
-                    self.resource.schema(exclude=tuple(self.resource.obj_exclude), only=tuple(self.resource.obj_only))
-                        .dump(objects.items, many=True).data, 'csv', 200, self.resource.model.__name__)
+                return make_response_from_records(schema.dump(objects.items, many=True).data, file_type, 200,
+                                                  self.resource.model.__name__)
             try:
-                resources = objects.paginate(page=self.resource.page, per_page=self.resource.limit)
+                items, total = self.resource.paginate(objects)
             except DataError as e:
                 return make_response(jsonify(dict(message='invalid query params', operation='Query Resource',
                                                   error=str(e))), 400)
-            if resources.items:
-                schema = self.resource.schema
-                if self.resource.only:
-                    data = schema(exclude=tuple(self.resource.obj_exclude), only=tuple(self.resource.obj_only))
-                else:
-                    data = schema(exclude=tuple(self.resource.obj_exclude))
-                return make_response(jsonify({'success': True,
-                                              'data': data
-                                             .dump(resources.items, many=True).data, 'total': resources.total}), 200)
+            if items:
+                response = {'success': True, 'data': schema.dump(items, many=True).data}
+                if total is not None:
+                    response['total'] = total
+                return make_response(jsonify(response), 200)
             return make_response(jsonify({'error': True, 'message': 'No Resource Found'}), 404)
 
+    def get_aggregate_page(self, objects):
+        try:
+            items, total = self.resource.paginate(self.resource.apply_aggregation(objects))
+        except CustomException as e:
+            e.message['error'] = True
+            return make_response(jsonify(e.message), e.status)
+        except DataError as e:
+            return make_response(jsonify(dict(message='invalid query params', operation='Query Resource',
+                                              error=str(e))), 400)
+        if items:
+            response = {'success': True, 'data': [item._asdict() for item in items]}
+            if total is not None:
+                response['total'] = total
+            return make_response(jsonify(response), 200)
+        return make_response(jsonify({'error': True, 'message': 'No Resource Found'}), 404)
+
+    def get_keyset_page(self, objects):
+        schema = self.resource.get_schema()
+        try:
+            total = self.resource.get_total(objects)
+            objects, ordering = self.resource.apply_keyset(objects)
+            objects = self.resource.apply_loading(objects, schema, extra=[key for key, _ in ordering])
+            # one extra row tells us whether there is a next page without counting
+            items = objects.limit(self.resource.limit + 1).all()
+        except CustomException as e:
+            e.message['error'] = True
+            return make_response(jsonify(e.message), e.status)
+        except DataError as e:
+            return make_response(jsonify(dict(message='invalid query params', operation='Query Resource',
+                                              error=str(e))), 400)
+        if items:
+            next_cursor = None
+            if len(items) > self.resource.limit:
+                items = items[:self.resource.limit]
+                next_cursor = self.resource.encode_cursor(ordering, items[-1])
+            response = {'success': True, 'data': schema.dump(items, many=True).data, 'next_cursor': next_cursor}
+            if total is not None:
+                response['total'] = total
+            return make_response(jsonify(response), 200)
+        return make_response(jsonify({'error': True, 'message': 'No Resource Found'}), 404)
+
     def post(self):
         try:
-            data, status = self.resource.save_resource()
+            if '__bulk' in request.args:
+                data, status = self.resource.bulk_save_resource()
+            else:
+                data, status = self.resource.save_resource()
         except (SQLIntegrityError, SQlOperationalError, SQlInvalidRequestError) as e:
             db.session.rollback()
             e.message['error'] = True
@@ -161,7 +218,10 @@ class BaseView(Resource):
     def put(self):
 
         try:
-            data, status = self.resource.update_resource()
+            if '__bulk' in request.args:
+                data, status = self.resource.bulk_update_resource()
+            else:
+                data, status = self.resource.update_resource()
         except (SQLIntegrityError, SQlOperationalError, SQlInvalidRequestError) as e:
             db.session.rollback()
             e.message['error'] = True
@@ -235,16 +295,17 @@ class AssociationView(Resource):
 
             if '__order_by' in request.args:
                 objects = self.resource.apply_ordering(objects, request.args['__order_by'])
-            resources = objects.paginate(page=self.resource.page, per_page=self.resource.limit)
-            if resources.items:
+            items, total = self.resource.paginate(objects)
+            if items:
                 schema = self.resource.schema
                 if self.resource.only:
                     data = schema(exclude=tuple(self.resource.obj_exclude), only=tuple(self.resource.obj_only))
                 else:
                     data = schema(exclude=tuple(self.resource.obj_exclude))
-                return make_response(jsonify({'success': True,
-                                              'data': data
-                                             .dump(resources.items, many=True).data, 'total': resources.total}), 200)
+                response = {'success': True, 'data': data.dump(items, many=True).data}
+                if total is not None:
+                    response['total'] = total
+                return make_response(jsonify(response), 200)
             return make_response(jsonify({'error': True, 'message': 'No Resource Found'}), 404)
 
     def post(self):
@@ -286,7 +347,49 @@ class DataView(Resource):
         # self.method_decorators.append(check_shop_access)
         self.method_decorators.append(roles_required(*[i for i in self.resource.roles_required]))
         self.method_decorators.append(roles_accepted(*[i for i in self.resource.roles_accepted]))
+        self.method_decorators.append(set_user)
 
-    @abstractmethod
     def get(self, slug=None):
-        pass
+        try:
+            objects, _ = self.resource.get_export_queryset()
+
+            if '__export__' in request.args and self.resource.export is True:
+                file_type = get_export_file_type()
+                if '__async' in request.args:
+                    return make_response(jsonify(start_export(self.resource, file_type)), 202)
+                if file_type == 'csv':
+                    return make_csv_response(self.resource.export_rows(objects, None), self.resource.model.__name__,
+                                             headers=self.resource.get_export_headers())
+                return make_response_from_records([row._asdict() for row in
+                                                   objects.limit(self.resource.max_export_limit)],
+                                                  file_type, 200, self.resource.model.__name__)
+
+            items, total = self.resource.paginate(objects)
+        except CustomException as e:
+            e.message['error'] = True
+            return make_response(jsonify(e.message), e.status)
+        except DataError as e:
+            return make_response(jsonify(dict(message='invalid query params', operation='Query Report',
+                                              error=str(e))), 400)
+        if items:
+            return make_response(jsonify({'success': True, 'data': [item._asdict() for item in items], 'total': total,
+                                          'start_date': self.resource.start_date,
+                                          'end_date': self.resource.end_date}), 200)
+        return make_response(jsonify({'error': True, 'message': 'No Resource Found'}), 404)
+
+
+class ExportResource(Resource):
+
+    method_decorators = [set_user, jwt_required]
+
+    def get(self, job_id):
+        job = get_export_job(job_id)
+        if not job or job['user_id'] != str(current_user.id):
+            return make_response(jsonify({'error': True, 'message': 'Export not found'}), 404)
+        if job['status'] != 'done':
+            return make_response(jsonify(export_job_response(job_id, job)), 200)
+        return send_file(export_file_path(job_id, job['file_type']), as_attachment=True,
+                         attachment_filename='{0}.{1}'.format(job['file_name'], job['file_type']))
+
+
+api.add_resource(ExportResource, '/export/<string:job_id>/', endpoint='export')
@@ -0,0 +1,100 @@
+import asyncio
+
+import aiohttp
+from razorpay.constants import URL, ERROR_CODE
+from razorpay.errors import BadRequestError, GatewayError, ServerError
+
+from .razorpay import razor
+from .sms import sms
+from .url_shortener import url_shortener
+
+
+class AsyncSession(object):
+
+    def __init__(self, client):
+        self.client = client
+        self.session = None
+        self.semaphore = None
+
+    async def __aenter__(self):
+        self.semaphore = asyncio.Semaphore(self.client.concurrency)
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.client.concurrency,
+                                           limit_per_host=self.client.concurrency_per_host),
+            timeout=aiohttp.ClientTimeout(total=self.client.timeout))
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.session.close()
+
+    async def request(self, method, url, idempotent=False, **kwargs):
+        # same policy as http_pool: connect failures are always retried, anything else only for idempotent calls
+        for attempt in range(self.client.retries + 1):
+            last_attempt = attempt == self.client.retries
+            try:
+                async with self.semaphore:
+                    async with self.session.request(method, url, **kwargs) as response:
+                        if response.status < 500 or not idempotent or last_attempt:
+                            return response.status, await response.json(content_type=None)
+            except aiohttp.ClientConnectorError:
+                if last_attempt:
+                    raise
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if not idempotent or last_attempt:
+                    raise
+            await asyncio.sleep(self.client.backoff_factor * (2 ** attempt))
+
+    async def razorpay(self, method, path, data=None):
+        status, body = await self.request(method, URL.BASE_URL + path, idempotent=method == 'GET', json=data,
+                                          auth=aiohttp.BasicAuth(razor.key or '', razor.secret or ''))
+        if 200 <= status < 300:
+            return body
+        error = (body or {}).get('error', {})
+        code = str(error.get('code', '')).upper()
+        if code == ERROR_CODE.BAD_REQUEST_ERROR:
+            raise BadRequestError(error.get('description', ''))
+        if code == ERROR_CODE.GATEWAY_ERROR:
+            raise GatewayError(error.get('description', ''))
+        raise ServerError(error.get('description', ''))
+
+    async def send_sms(self, content, sender='PAYNUD', route=4, country=91):
+        return await self.request('POST', sms.url, json=dict(sender=sender, route=route, country=country, sms=content),
+                                  headers={'content-type': 'application/json', 'authkey': sms.key})
+
+    async def get_short_url(self, link):
+        status, body = await self.request('POST', url_shortener.url, params=dict(key=url_shortener.key),
+                                          json=dict(longUrl=url_shortener.domain + link))
+        if 200 <= status < 300:
+            return body['id']
+        return None
+
+
+class AsyncHttp(object):
+
+    concurrency = 100
+    concurrency_per_host = 50
+    timeout = 30
+    retries = 3
+    backoff_factor = 0.3
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app=None):
+        self.concurrency = app.config.get('ASYNC_HTTP_CONCURRENCY', self.concurrency)
+        self.concurrency_per_host = app.config.get('ASYNC_HTTP_CONCURRENCY_PER_HOST', self.concurrency_per_host)
+        self.timeout = app.config.get('ASYNC_HTTP_TIMEOUT', self.timeout)
+        self.retries = app.config.get('ASYNC_HTTP_RETRIES', self.retries)
+
+    def run(self, fn, *args):
+        # celery tasks are synchronous, every call gets its own event loop and connector so nothing outlives the
+        # task or leaks into forked workers
+        async def runner():
+            async with AsyncSession(self) as session:
+                return await fn(session, *args)
+
+        return asyncio.run(runner())
+
+
+async_http = AsyncHttp()
@@ -0,0 +1,86 @@
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app
+
+from .redis import redis_store
+
+
+class TTLCache(object):
+    """Thread safe, per process LRU cache whose entries expire after `timeout` seconds."""
+
+    def __init__(self, maxsize=1024, timeout=30):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.timeout, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+
+class SetCache(object):
+    """Caches sets of ids per key in a local TTLCache backed by a redis set, loading misses with `loader`."""
+
+    # redis drops empty sets, so every cached set carries this member
+    sentinel = '-'
+
+    def __init__(self, name, loader, config_prefix):
+        self.name = name
+        self.loader = loader
+        self.config_prefix = config_prefix
+        self._local = None
+
+    def config(self, key, default):
+        return current_app.config.get('{0}_{1}'.format(self.config_prefix, key), default)
+
+    @property
+    def local(self):
+        if self._local is None:
+            self._local = TTLCache(maxsize=self.config('SIZE', 1024), timeout=self.config('LOCAL_TIMEOUT', 30))
+        return self._local
+
+    def redis_key(self, key):
+        return '{0}:{1}'.format(self.name, key)
+
+    def get(self, key):
+        value = self.local.get(key)
+        if value is not None:
+            return value
+
+        members = redis_store.smembers(self.redis_key(key))
+        if members:
+            value = frozenset(int(member) for member in members if member.decode('utf-8') != self.sentinel)
+        else:
+            value = frozenset(self.loader(key))
+            pipe = redis_store.pipeline()
+            pipe.sadd(self.redis_key(key), self.sentinel, *value)
+            pipe.expire(self.redis_key(key), self.config('TIMEOUT', 600))
+            pipe.execute()
+        self.local.set(key, value)
+        return value
+
+    def invalidate(self, key):
+        self.local.pop(key)
+        redis_store.delete(self.redis_key(key))
@@ -0,0 +1,186 @@
+import csv
+import hashlib
+import io
+import json
+import os
+import time
+import uuid
+from importlib import import_module
+
+import pyexcel
+from flask import Response, request, current_app, stream_with_context, url_for
+from flask_security import current_user
+from flask_security.decorators import _security, _request_ctx_stack
+
+from .celery import celery
+from .exceptions import CustomException
+from .redis import redis_store
+
+# flush the csv buffer to the client whenever it grows past this many characters
+CSV_BUFFER_SIZE = 64 * 1024
+
+
+def format_csv_value(value):
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, default=str)
+    return value
+
+
+def csv_stream(rows, headers=None):
+    buffer = io.StringIO()
+    writer = None
+    for row in rows:
+        if writer is None:
+            writer = csv.DictWriter(buffer, fieldnames=headers or list(row.keys()), extrasaction='ignore')
+            writer.writeheader()
+        writer.writerow({key: format_csv_value(value) for key, value in row.items()})
+        if buffer.tell() > CSV_BUFFER_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate(0)
+    if writer is None and headers:
+        csv.writer(buffer).writerow(headers)
+    yield buffer.getvalue()
+
+
+def make_csv_response(rows, file_name, headers=None):
+    return Response(stream_with_context(csv_stream(rows, headers)), mimetype='text/csv',
+                    headers={'Content-Disposition': 'attachment; filename={0}.csv'.format(file_name)})
+
+
+# query params that do not change the exported file
+EXPORT_IGNORED_PARAMS = ('__async', '__page', '__limit', '__cursor', '__after', '__count')
+
+EXPORT_FILE_TYPES = ('csv', 'xls', 'xlsx')
+
+
+def get_export_file_type():
+    file_type = request.args.get('__export__') or 'csv'
+    if file_type not in EXPORT_FILE_TYPES:
+        raise CustomException(data={'__export__': file_type}, message='Invalid export format',
+                              operation='Export Resource')
+    return file_type
+
+
+def export_job_key(job_id):
+    return 'export:{0}'.format(job_id)
+
+
+def export_lock_key(digest):
+    return 'export:active:{0}'.format(digest)
+
+
+def export_file_path(job_id, file_type, suffix=''):
+    if file_type not in EXPORT_FILE_TYPES:
+        raise ValueError('Invalid export format: {0}'.format(file_type))
+    return os.path.join(current_app.config['EXPORT_FOLDER'], '{0}{1}.{2}'.format(job_id, suffix, file_type))
+
+
+def get_export_job(job_id):
+    job = redis_store.hgetall(export_job_key(job_id))
+    return {key.decode('utf-8'): value.decode('utf-8') for key, value in job.items()}
+
+
+def export_job_response(job_id, job):
+    return dict(job_id=job_id, status=job.get('status'), rows=int(job.get('rows', 0)),
+                total=int(job['total']) if job.get('total') else None,
+                download_url=url_for('pos.export', job_id=job_id))
+
+
+def start_export(resource, file_type):
+    args = {key: request.args.getlist(key) for key in request.args.keys() if key not in EXPORT_IGNORED_PARAMS}
+    resource_path = '{0}.{1}'.format(resource.__class__.__module__, resource.__class__.__name__)
+    digest = hashlib.sha1(json.dumps([resource_path, current_user.id, file_type, sorted(args.items())])
+                          .encode('utf-8')).hexdigest()
+    lock_key = export_lock_key(digest)
+
+    # identical requests made while a job is queued or running all get that job back, once it finishes the lock is
+    # released so the next request exports current data instead of reusing the old file
+    while True:
+        job_id = uuid.uuid4().hex
+        if redis_store.set(lock_key, job_id, nx=True, ex=current_app.config['EXPORT_JOB_TIMEOUT']):
+            key = export_job_key(job_id)
+            pipe = redis_store.pipeline()
+            pipe.hmset(key, dict(status='queued', user_id=current_user.id, file_type=file_type, rows=0, lock=digest,
+                                 file_name=resource.model.__name__ if resource.model else resource.__class__.__name__))
+            pipe.expire(key, current_app.config['EXPORT_JOB_TIMEOUT'])
+            pipe.execute()
+            export_resource.delay(job_id, resource_path, current_user.id, args, file_type)
+            break
+        running = redis_store.get(lock_key)
+        if running is not None:
+            job_id = running.decode('utf-8')
+            break
+    return export_job_response(job_id, get_export_job(job_id))
+
+
+def release_export_lock(job_id):
+    lock = redis_store.hget(export_job_key(job_id), 'lock')
+    if lock is not None:
+        lock_key = export_lock_key(lock.decode('utf-8'))
+        if redis_store.get(lock_key) == job_id.encode('utf-8'):
+            redis_store.delete(lock_key)
+
+
+def count_rows(rows, key, every):
+    count = 0
+    for row in rows:
+        yield row
+        count += 1
+        if count % every == 0:
+            redis_store.hset(key, 'rows', count)
+    redis_store.hset(key, 'rows', count)
+
+
+@celery.task(name='celery.export_resource', acks_late=True)
+def export_resource(job_id, resource_path, user_id, args, file_type):
+    key = export_job_key(job_id)
+    module_name, class_name = resource_path.rsplit('.', 1)
+    resource_class = getattr(import_module(module_name), class_name)
+    path = export_file_path(job_id, file_type)
+    part_path = export_file_path(job_id, file_type, '.part')
+    try:
+        with celery.app.test_request_context(query_string=args):
+            _request_ctx_stack.top.user = _security.datastore.get_user(user_id)
+            resource = resource_class()
+            queryset, schema = resource.get_export_queryset()
+            redis_store.hmset(key, dict(status='running', total=queryset.order_by(None).count()))
+
+            rows = count_rows(resource.export_rows(queryset, schema), key, resource.export_chunk_size)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if file_type == 'csv':
+                with open(part_path, 'w', newline='') as f:
+                    for chunk in csv_stream(rows):
+                        f.write(chunk)
+            else:
+                pyexcel.isave_as(records=rows, dest_file_name=part_path)
+                pyexcel.free_resources()
+            os.replace(part_path, path)
+    except Exception:
+        redis_store.hset(key, 'status', 'failed')
+        release_export_lock(job_id)
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+    redis_store.hset(key, 'status', 'done')
+    release_export_lock(job_id)
+
+
+@celery.task(name='celery.cleanup_exports')
+def cleanup_exports():
+    # a file is written when its job finishes, so it is older than the job timeout only once the job hash that
+    # serves it has expired. leftover .part files of crashed workers go the same way
+    folder = current_app.config['EXPORT_FOLDER']
+    if not os.path.isdir(folder):
+        return 0
+    expired = time.time() - current_app.config['EXPORT_JOB_TIMEOUT']
+    removed = 0
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if entry.is_file() and entry.stat().st_mtime < expired:
+                try:
+                    os.remove(entry.path)
+                    removed += 1
+                except FileNotFoundError:
+                    pass
+    return removed
@@ -35,10 +35,10 @@ class CustomJSONEncoder(JSONEncoder):
                     obj.microsecond / 1000
                 )
                 return millis
-            iterable = iter(obj)
             if isinstance(obj, decimal.Decimal):
                 # Convert decimal instances to strings.
                 return float(obj)
+            iterable = iter(obj)
         except TypeError:
             pass
         else:
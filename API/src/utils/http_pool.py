@@ -0,0 +1,117 @@
+import os
+import threading
+from collections import Counter
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class PooledSession(requests.Session):
+
+    def __init__(self, pool):
+        super(PooledSession, self).__init__()
+        self.pool = pool
+
+    def request(self, method, url, **kwargs):
+        # requests has no session wide timeout, fall back to the one configured for the host
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.pool.get_host_config(urlsplit(url).hostname)['timeout']
+        return super(PooledSession, self).request(method, url, **kwargs)
+
+
+class HttpPool(object):
+
+    defaults = {
+        'pool_connections': 10,
+        'pool_size': 10,
+        'pool_block': False,
+        'timeout': (3.05, 10),
+        'retries': 3,
+        'backoff_factor': 0.3,
+        'status_forcelist': (502, 503, 504),
+    }
+
+    def __init__(self, app=None):
+        self.config = {}
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._requests = Counter()
+        self._errors = Counter()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app=None):
+        # {'default': {...}, '<host>': {...}}, see HttpPool.defaults for the keys
+        self.config = app.config.get('HTTP_POOL_CONFIG', {})
+
+    def get_host_config(self, host=None):
+        config = dict(self.defaults, **self.config.get('default', {}))
+        config.update(self.config.get(host, {}))
+        return config
+
+    def get_adapter(self, host=None):
+        config = self.get_host_config(host)
+        # urllib3 only retries requests that never reached the server, or idempotent methods on read errors
+        retry = Retry(total=config['retries'], backoff_factor=config['backoff_factor'],
+                      status_forcelist=config['status_forcelist'], raise_on_status=False)
+        return HTTPAdapter(pool_connections=config['pool_connections'], pool_maxsize=config['pool_size'],
+                           pool_block=config['pool_block'], max_retries=retry)
+
+    def create_session(self):
+        session = PooledSession(self)
+        session.mount('http://', self.get_adapter())
+        session.mount('https://', self.get_adapter())
+        for host in self.config:
+            if host != 'default':
+                session.mount('https://{0}/'.format(host), self.get_adapter(host))
+                session.mount('http://{0}/'.format(host), self.get_adapter(host))
+        session.hooks['response'].append(self.count_response)
+        return session
+
+    @property
+    def session(self):
+        # one session per process, sockets must not be shared with forked celery workers; urllib3 pools are
+        # thread safe so threads of a process share it
+        pid = os.getpid()
+        session = self._sessions.get(pid)
+        if session is None:
+            with self._lock:
+                session = self._sessions.get(pid)
+                if session is None:
+                    self._sessions = {pid: self.create_session()}
+                    session = self._sessions[pid]
+        return session
+
+    def count_response(self, response, *args, **kwargs):
+        host = urlsplit(response.url).hostname
+        with self._lock:
+            self._requests[host] += 1
+            if response.status_code >= 500:
+                self._errors[host] += 1
+
+    def request(self, method, url, **kwargs):
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def stats(self):
+        pools = {}
+        session = self._sessions.get(os.getpid())
+        if session is not None:
+            for adapter in set(session.adapters.values()):
+                for key in adapter.poolmanager.pools.keys():
+                    pool = adapter.poolmanager.pools[key]
+                    pools[pool.host] = dict(pool_size=pool.pool.maxsize if pool.pool else 0,
+                                            idle=pool.pool.qsize() if pool.pool else 0,
+                                            connections=pool.num_connections, requests=pool.num_requests)
+        with self._lock:
+            return dict(pid=os.getpid(), pools=pools, responses=dict(self._requests), server_errors=dict(self._errors))
+
+
+http_pool = HttpPool()
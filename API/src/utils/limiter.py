@@ -8,4 +8,5 @@ limiter = Limiter(key_func=get_remote_address)
 @limiter.request_filter
 def header_whitelist():
     token = request.headers.get('authorization')
-    return request.method == 'OPTIONS'
+    # razorpay delivers renewal bursts from a handful of addresses
+    return request.method == 'OPTIONS' or (request.endpoint or '').endswith('razorpay_webhook')
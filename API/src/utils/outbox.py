@@ -0,0 +1,89 @@
+import time
+
+from sqlalchemy.dialects.postgresql import JSONB
+
+from .celery import celery
+from .models import db, BaseMixin, ReprMixin
+from .resource import chunked
+from .sentry import sentry
+
+
+class OutboxMessage(BaseMixin, ReprMixin, db.Model):
+    __repr_fields__ = ['id', 'task']
+
+    task = db.Column(db.String(100), nullable=False)
+    args = db.Column(JSONB, nullable=False, default=list)
+    kwargs = db.Column(JSONB, nullable=False, default=dict)
+
+
+class Outbox(object):
+
+    batch_size = 500
+    poll_interval = 0.5
+    max_backoff = 30
+
+    def __init__(self, app=None):
+        # tasks taking a single list of ids, the relay merges their queued calls into chunks of this size
+        self.batchable = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app=None):
+        self.batch_size = app.config.get('OUTBOX_BATCH_SIZE', self.batch_size)
+        self.poll_interval = app.config.get('OUTBOX_POLL_INTERVAL', self.poll_interval)
+        self.max_backoff = app.config.get('OUTBOX_MAX_BACKOFF', self.max_backoff)
+
+    def enqueue(self, task, *args, **kwargs):
+        # written with the caller's transaction, the task is only sent once that commits
+        db.session.add(OutboxMessage(task=task.name, args=list(args), kwargs=kwargs))
+
+    def register_batchable(self, task, chunk_size=100):
+        self.batchable[task.name] = chunk_size
+        return task
+
+    def merge(self, messages):
+        calls, batched = [], {}
+        for task, args, kwargs in messages:
+            if task in self.batchable and len(args) == 1 and isinstance(args[0], list) and not kwargs:
+                batched.setdefault(task, []).extend(args[0])
+            else:
+                calls.append((task, args, kwargs))
+        for task, ids in batched.items():
+            calls.extend((task, [chunk], {}) for chunk in chunked(ids, self.batchable[task]))
+        return calls
+
+    def relay(self):
+        # rows are deleted and sent in one transaction, if the broker fails the delete rolls back and they are
+        # picked up again, so every task is sent at least once
+        table = OutboxMessage.__table__
+        pending = db.select([table.c.id]).order_by(table.c.id).limit(self.batch_size).with_for_update(skip_locked=True)
+        try:
+            messages = db.session.execute(table.delete().where(table.c.id.in_(pending))
+                                          .returning(table.c.task, table.c.args, table.c.kwargs)).fetchall()
+            with celery.producer_or_acquire() as producer:
+                for task, args, kwargs in self.merge(messages):
+                    celery.send_task(task, args=args, kwargs=kwargs, producer=producer)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return len(messages)
+
+    def run(self):
+        # a broker or database outage only pauses the relay, it backs off and keeps trying until they are back
+        failures = 0
+        while True:
+            try:
+                relayed = self.relay()
+            except Exception:
+                sentry.captureException()
+                db.session.remove()
+                failures += 1
+                time.sleep(min(self.poll_interval * 2 ** failures, self.max_backoff))
+                continue
+            failures = 0
+            if relayed < self.batch_size:
+                time.sleep(self.poll_interval)
+
+
+outbox = Outbox()
@@ -1,19 +1,31 @@
 import razorpay
 
+from .http_pool import http_pool
+
 
 class FlaskRazorPay(razorpay.Client):
     key = ""
     secret = ""
 
     def __init__(self, app=None):
+        super(FlaskRazorPay, self).__init__(auth=(self.key, self.secret))
+
         if app is not None:
             self.init_app(app)
 
-        super(FlaskRazorPay, self).__init__(auth=(self.key, self.secret))
-
     def init_app(self, app=None):
         self.key = app.config.get('RAZOR_PAY_KEY', None)
         self.secret = app.config.get('RAZOR_PAY_SECRET', None)
-        
+        self.auth = (self.key, self.secret)
+
+    @property
+    def session(self):
+        return http_pool.session
+
+    @session.setter
+    def session(self, session):
+        # razorpay.Client sets its own requests.Session, requests go through the shared pool instead
+        pass
+
 
 razor = FlaskRazorPay()
@@ -1,17 +1,136 @@
+import hashlib
+import json
 from abc import ABC, abstractmethod
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta, time
+from decimal import Decimal
+from types import SimpleNamespace
 from dateutil.relativedelta import relativedelta
 from flask import request
 from flask_security import current_user
-from sqlalchemy import and_
+from itsdangerous import BadData
+from sqlalchemy import and_, or_, false, inspect, func, literal_column
 from sqlalchemy.exc import OperationalError, IntegrityError, InvalidRequestError
+from sqlalchemy.types import Date, DateTime
+from marshmallow.fields import Nested
+from marshmallow_sqlalchemy.fields import Related
+from sqlalchemy.orm import load_only, joinedload, selectinload
 from sqlalchemy.orm.exc import DetachedInstanceError
-from typing import List, Tuple, Dict
+from typing import List, Tuple, Dict, Any
 
 from .exceptions import ResourceNotFound, SQLIntegrityError, SQlOperationalError, CustomException, RequestNotAllowed, \
     SQlInvalidRequestError, SQLDetachedInstanceError
 from .models import db
+from .redis import redis_store
 from .sentry import sentry
+from .serializer_helper import serializer_helper
+
+COUNT_POLICIES = ('exact', 'none', 'estimated', 'cached')
+
+EAGER_LOADERS = {
+    'joined': joinedload,
+    'selectin': selectinload,
+}
+
+AGGREGATES = {
+    'sum': func.sum,
+    'count': func.count,
+    'avg': func.avg,
+    'min': func.min,
+    'max': func.max,
+}
+
+DATE_BUCKETS = ('hour', 'day', 'week', 'month', 'quarter', 'year')
+
+# query params that change how a list is presented but not which rows it contains
+PRESENTATION_PARAMS = ('__page', '__limit', '__only', '__exclude', '__include', '__order_by', '__cursor', '__after',
+                       '__count', '__export__')
+
+
+def get_list_param(key):
+    values = request.args.getlist(key)
+    if len(values) == 1:
+        values = values[0].split(',')
+    return [value for value in values if value]
+
+
+def get_count_policy(default, cursor=False):
+    policy = request.args.get('__count')
+    if policy is None:
+        return 'none' if cursor else default
+    if not policy:
+        return 'exact'
+    return policy if policy in COUNT_POLICIES else default
+
+
+def normalized_filters():
+    return sorted((k, sorted(request.args.getlist(k))) for k in request.args.keys() if k not in PRESENTATION_PARAMS)
+
+
+def estimate_count(queryset):
+    # planner row estimate instead of scanning the filtered set, accurate enough for page counts
+    compiled = queryset.order_by(None).statement.compile(dialect=db.session.get_bind().dialect)
+    plan = db.session.connection().execute('EXPLAIN (FORMAT JSON) ' + str(compiled), compiled.params).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+def count_queryset(queryset, policy, cache_key, timeout):
+    if policy == 'none':
+        return None
+    if policy == 'estimated':
+        return estimate_count(queryset)
+    if policy == 'cached':
+        total = redis_store.get(cache_key)
+        if total is not None:
+            return int(total)
+        total = queryset.order_by(None).count()
+        redis_store.setex(cache_key, timeout, total)
+        return total
+    return queryset.order_by(None).count()
+
+
+def dump_cursor_value(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    return value
+
+
+def load_cursor_value(column, value):
+    if value is None:
+        return None
+    python_type = column.type.python_type
+    if python_type is datetime:
+        return datetime.fromisoformat(value)
+    if python_type is date:
+        return date.fromisoformat(value)
+    if python_type is Decimal:
+        return Decimal(value)
+    return value
+
+
+def chunked(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def seek_after(columns, values):
+    # Lexicographic "row after" predicate that works with mixed sort directions. Postgres sorts NULLs last
+    # for ASC and first for DESC, so nullable keys are handled explicitly.
+    clauses = []
+    for index, ((column, desc), value) in enumerate(zip(columns, values)):
+        if value is None:
+            after = column.isnot(None) if desc else false()
+        elif desc:
+            after = column < value
+        else:
+            after = or_(column > value, column.is_(None))
+        equals = [col.is_(None) if val is None else col == val
+                  for (col, _), val in zip(columns[:index], values[:index])]
+        clauses.append(and_(*equals, after))
+    return or_(*clauses)
 
 
 class ModelResource(ABC):
@@ -46,6 +165,30 @@ class ModelResource(ABC):
 
     max_export_limit: int = 5000
 
+    bulk_chunk_size: int = 1000
+
+    export_chunk_size: int = 1000
+
+    count_policy: str = 'exact'
+
+    count_cache_timeout: int = 60
+
+    # columns needed to compute dumped attributes that are not plain columns, e.g. hybrid properties
+    field_dependencies: Dict[str, Tuple[str]] = {}
+
+    # relationship -> 'joined', 'selectin' or None to leave it lazy; by default scalar relations are joined and
+    # collections are loaded with a second IN query
+    eager_load: Dict[str, str] = {}
+
+    # columns that can be used in __group_by, date columns can be bucketed with column:month
+    group_by: Tuple[str] = ()
+
+    # numeric columns that can be used in __aggregate as function:column
+    aggregate_fields: Tuple[str] = ()
+
+    # columns whose changes are handed to before_update_commit, their history is gone once the update is flushed
+    tracked_fields: Tuple[str] = ()
+
     roles_accepted: Tuple[str] = ()
 
     roles_required: Tuple[str] = ()
@@ -89,6 +232,10 @@ class ModelResource(ABC):
                                                          and int(
             request.args.get('__limit')) <= self.max_limit else self.default_limit
 
+        self.after = request.args.get('__after')
+        self.cursor = '__cursor' in request.args or self.after is not None
+        self.count_mode = get_count_policy(self.count_policy, self.cursor)
+
     def apply_filters(self, queryset, **kwargs):
         for k, v in kwargs.items():
             array_key = k.split('__')
@@ -128,6 +275,178 @@ class ModelResource(ABC):
                     queryset = queryset.order_by(getattr(self.model, order_by))
         return queryset
 
+    def get_keyset_ordering(self, order_by_list):
+        if len(order_by_list) == 1:
+            order_by_list = order_by_list[0].split(',')
+        ordering = []
+        for order_by in order_by_list:
+            desc = order_by.startswith('-')
+            order_by = order_by.lstrip('-')
+            if order_by in self.order_by and hasattr(self.model, order_by):
+                ordering.append((order_by, desc))
+                if order_by == 'id':
+                    return ordering
+        # id is appended as a tie-breaker so that every cursor points at exactly one row
+        ordering.append(('id', ordering[-1][1] if ordering else False))
+        return ordering
+
+    def encode_cursor(self, ordering, obj):
+        return serializer_helper.serialize_data({
+            'o': [('-' if desc else '') + key for key, desc in ordering],
+            'v': [dump_cursor_value(getattr(obj, key)) for key, _ in ordering]})
+
+    def decode_cursor(self, cursor):
+        try:
+            data = serializer_helper.deserialize_data(cursor)
+            ordering = [(key.lstrip('-'), key.startswith('-')) for key in data['o']]
+            if any(key != 'id' and key not in self.order_by for key, _ in ordering) or \
+                    len(ordering) != len(data['v']):
+                raise ValueError(cursor)
+            values = [load_cursor_value(getattr(self.model, key), value)
+                      for (key, _), value in zip(ordering, data['v'])]
+        except (BadData, KeyError, TypeError, ValueError):
+            raise CustomException(data={'__after': cursor}, message='Invalid cursor', operation='Query Resource')
+        return ordering, values
+
+    def apply_keyset(self, queryset):
+        if self.after:
+            ordering, values = self.decode_cursor(self.after)
+        else:
+            ordering, values = self.get_keyset_ordering(request.args.getlist('__order_by')), None
+        columns = [(getattr(self.model, key), desc) for key, desc in ordering]
+        if values is not None:
+            queryset = queryset.filter(seek_after(columns, values))
+        return queryset.order_by(*[column.desc() if desc else column.asc() for column, desc in columns]), ordering
+
+    def get_aggregation(self):
+        group_by, aggregates = [], []
+        for value in get_list_param('__group_by'):
+            name, _, bucket = value.partition(':')
+            column = getattr(self.model, name) if name in self.group_by else None
+            if column is None or (bucket and (bucket not in DATE_BUCKETS or
+                                              not isinstance(getattr(column, 'type', None), (Date, DateTime)))):
+                raise CustomException(data={'__group_by': value}, message='Invalid group by',
+                                      operation='Query Resource')
+            if bucket:
+                column = func.date_trunc(bucket, column)
+            group_by.append(column.label(name))
+
+        for value in get_list_param('__aggregate'):
+            function, _, name = value.partition(':')
+            if function not in AGGREGATES or (name and name not in self.aggregate_fields) \
+                    or (not name and function != 'count'):
+                raise CustomException(data={'__aggregate': value}, message='Invalid aggregate',
+                                      operation='Query Resource')
+            column = getattr(self.model, name) if name else literal_column('*')
+            aggregates.append(AGGREGATES[function](column)
+                              .label('{0}_{1}'.format(function, name) if name else function))
+        return group_by, aggregates or [func.count(literal_column('*')).label('count')]
+
+    def apply_aggregation(self, queryset):
+        group_by, aggregates = self.get_aggregation()
+        queryset = queryset.order_by(None).with_entities(*group_by, *aggregates)
+        if group_by:
+            queryset = queryset.group_by(*[column.element for column in group_by]).order_by(*group_by)
+        return queryset
+
+    def get_schema(self):
+        if self.obj_only:
+            return self.schema(exclude=tuple(self.obj_exclude), only=tuple(self.obj_only))
+        return self.schema(exclude=tuple(self.obj_exclude))
+
+    def get_projection(self, schema, extra=()):
+        mapper = inspect(self.model)
+        columns = {attr.key for attr in mapper.column_attrs}
+        relationships = {rel.key: rel for rel in mapper.relationships}
+
+        projection = {mapper.get_property_by_column(column).key for column in mapper.primary_key}
+        projection.update(extra)
+        for name, field in schema.fields.items():
+            if field.load_only:
+                continue
+            attribute = field.attribute or name
+            if attribute in columns:
+                projection.add(attribute)
+            elif attribute in relationships:
+                projection.update(mapper.get_property_by_column(column).key
+                                  for column in relationships[attribute].local_columns)
+            elif attribute in self.field_dependencies:
+                projection.update(self.field_dependencies[attribute])
+            else:
+                # python side attribute with unknown inputs, loading every column is the only safe choice
+                return None
+        return projection
+
+    def apply_projection(self, queryset, schema, extra=()):
+        projection = self.get_projection(schema, extra)
+        if projection is None or len(projection) == len(inspect(self.model).column_attrs):
+            return queryset
+        return queryset.options(load_only(*projection))
+
+    def get_eager_options(self, schema):
+        relationships = {rel.key: rel for rel in inspect(self.model).relationships}
+        options = []
+        for name, field in schema.fields.items():
+            attribute = field.attribute or name
+            if field.load_only or not isinstance(field, (Nested, Related)) or attribute not in relationships:
+                continue
+            relationship = relationships[attribute]
+            strategy = self.eager_load.get(attribute, 'selectin' if relationship.uselist else 'joined')
+            if strategy not in EAGER_LOADERS or relationship.lazy == 'dynamic':
+                continue
+            option = EAGER_LOADERS[strategy](getattr(self.model, attribute))
+            nested_only = getattr(field, 'only', None)
+            if isinstance(field, Nested) and nested_only and not isinstance(nested_only, str) and \
+                    set(nested_only) <= {attr.key for attr in relationship.mapper.column_attrs}:
+                option = option.load_only(*nested_only)
+            options.append(option)
+        return options
+
+    def apply_eager_loading(self, queryset, schema):
+        options = self.get_eager_options(schema)
+        return queryset.options(*options) if options else queryset
+
+    def apply_expressions(self, queryset, schema):
+        return queryset
+
+    def apply_loading(self, queryset, schema, extra=()):
+        queryset = self.apply_projection(queryset, schema, extra)
+        queryset = self.apply_eager_loading(queryset, schema)
+        return self.apply_expressions(queryset, schema)
+
+    def get_count_cache_key(self):
+        filters = json.dumps(normalized_filters(), sort_keys=True)
+        return 'count:{0}:{1}:{2}'.format(self.__class__.__name__, getattr(current_user, 'id', None),
+                                          hashlib.sha1(filters.encode('utf-8')).hexdigest())
+
+    def get_total(self, queryset):
+        return count_queryset(queryset, self.count_mode, self.get_count_cache_key(), self.count_cache_timeout)
+
+    def paginate(self, queryset):
+        items = queryset.limit(self.limit).offset((self.page - 1) * self.limit).all()
+        if self.count_mode != 'none' and self.page == 1 and len(items) < self.limit:
+            return items, len(items)
+        return items, self.get_total(queryset)
+
+    def get_export_queryset(self):
+        queryset = self.apply_filters(queryset=self.model.query, **request.args)
+        queryset = self.has_read_permission(queryset)
+        if '__order_by' in request.args:
+            queryset = self.apply_ordering(queryset, request.args.getlist('__order_by'))
+        schema = self.get_schema()
+        return self.apply_loading(queryset, schema), schema
+
+    def export_rows(self, queryset, schema):
+        # server side cursor, only export_chunk_size objects are alive at a time
+        chunk = []
+        for obj in queryset.yield_per(self.export_chunk_size):
+            chunk.append(obj)
+            if len(chunk) == self.export_chunk_size:
+                yield from schema.dump(chunk, many=True).data
+                chunk = []
+        if chunk:
+            yield from schema.dump(chunk, many=True).data
+
     def patch_resource(self, slug):
         obj = self.model.query.get(slug)
         if obj and self.has_change_permission(obj):
@@ -138,6 +457,9 @@ class ModelResource(ABC):
 
             try:
                 if self.has_change_permission(obj):
+                    changes = [self.get_changed_fields(obj)]
+                    db.session.flush()
+                    self.before_update_commit([obj], changes)
                     db.session.commit()
                     self.after_objects_save([obj])
                 else:
@@ -172,42 +494,155 @@ class ModelResource(ABC):
 
     def update_resource(self):
         data = request.json if isinstance(request.json, list) else [request.json]
+        instances = [self.schema().get_instance(d) for d in data]
+        if not all(instances) or not self.has_bulk_change_permission(instances):
+            return {'error': True, 'message': 'Forbidden Permission Denied To Add Resource'}, 403
         objects = []
-        for d in data:
-            obj = self.schema().get_instance(d)
-            if not obj or not self.has_change_permission(obj):
-                return {'error': True, 'message': 'Forbidden Permission Denied To Add Resource'}, 403
-            obj, errors = self.schema().load(d, instance=obj)
+        for d, instance in zip(data, instances):
+            obj, errors = self.schema().load(d, instance=instance)
             if errors:
                 sentry.captureMessage(errors)
                 db.session.rollback()
                 return {'error': True, 'message': str(errors)}, 400
+            objects.append(obj)
 
-            if not self.has_change_permission(obj):
-                db.session.rollback()
-                return {'error': True, 'message': 'Forbidden Permission Denied To Add Resource'}, 403
-            try:
-                db.session.commit()
-                objects.append(obj)
-            except IntegrityError:
-                sentry.captureException()
-                db.session.rollback()
-                raise SQLIntegrityError(data=d, message='Integrity Error', operation='Updating Resource', status=400)
-            except OperationalError:
-                sentry.captureException()
-                db.session.rollback()
-                raise SQlOperationalError(data=d, message='Operational Error', operation='Updating Resource',
-                                          status=400)
-            except InvalidRequestError:
-                sentry.captureException()
-                db.session.rollback()
-                raise SQlInvalidRequestError(data=d, message='Invalid Request Error', operation='Adding Resource',
-                                             status=400)
+        if not self.has_bulk_change_permission(objects):
+            db.session.rollback()
+            return {'error': True, 'message': 'Forbidden Permission Denied To Add Resource'}, 403
+        changes = [self.get_changed_fields(obj) for obj in objects]
+        try:
+            db.session.flush()
+            self.before_update_commit(objects, changes)
+            db.session.commit()
+        except IntegrityError:
+            sentry.captureException()
+            db.session.rollback()
+            raise SQLIntegrityError(data=data, message='Integrity Error', operation='Updating Resource', status=400)
+        except OperationalError:
+            sentry.captureException()
+            db.session.rollback()
+            raise SQlOperationalError(data=data, message='Operational Error', operation='Updating Resource',
+                                      status=400)
+        except InvalidRequestError:
+            sentry.captureException()
+            db.session.rollback()
+            raise SQlInvalidRequestError(data=data, message='Invalid Request Error', operation='Adding Resource',
+                                         status=400)
         self.after_objects_save(objects)
         return {'success': True, 'message': 'Resource Updated successfully',
                 'data': self.schema(exclude=tuple(self.obj_exclude), only=tuple(self.obj_only))
                     .dump(objects, many=True).data}, 201
 
+    def get_changed_fields(self, obj):
+        state = inspect(obj)
+        return {key for key in self.tracked_fields if state.attrs[key].history.has_changes()}
+
+    def coerce_id(self, value):
+        python_type = self.model.id.type.python_type
+        if isinstance(value, bool) or not isinstance(value, (str, python_type)):
+            return None
+        try:
+            return python_type(value)
+        except ValueError:
+            return None
+
+    def load_bulk_row(self, d, instance, allowed):
+        # (object, changed tracked fields, None) for a row that can be applied, (None, None, message) otherwise
+        if not allowed and not self.has_change_permission(instance):
+            return None, None, 'Forbidden Permission Denied To Change Resource'
+        obj, load_errors = self.schema().load(d, instance=instance)
+        if load_errors:
+            return None, None, str(load_errors)
+        if not self.has_change_permission(obj):
+            return None, None, 'Forbidden Permission Denied To Change Resource'
+        return obj, self.get_changed_fields(obj), None
+
+    def apply_bulk_rows(self, rows, instances, allowed, errors):
+        objects, changes = [], []
+        for index, d, obj_id, _, _ in rows:
+            savepoint = db.session.begin_nested()
+            with db.session.no_autoflush:
+                obj, changed, message = self.load_bulk_row(d, instances[obj_id], allowed)
+            if message is None:
+                try:
+                    savepoint.commit()
+                    objects.append(obj)
+                    changes.append(changed)
+                    continue
+                except IntegrityError as e:
+                    message = str(e.orig)
+            savepoint.rollback()
+            errors.append({'index': index, 'id': obj_id, 'message': message})
+        return objects, changes
+
+    def bulk_update_resource(self):
+        data = request.json if isinstance(request.json, list) else [request.json]
+        ids = [self.coerce_id(d.get('id')) if isinstance(d, dict) else None for d in data]
+        wanted = {obj_id for obj_id in ids if obj_id is not None}
+        instances = {obj.id: obj for obj in self.model.query.filter(self.model.id.in_(wanted))} if wanted else {}
+        with db.session.no_autoflush:
+            # one set based check for the whole batch, per row checks only to find the offending rows
+            allowed = self.has_bulk_change_permission(list(instances.values()))
+
+        rows, errors, seen = [], [], set()
+        for index, (d, obj_id) in enumerate(zip(data, ids)):
+            if obj_id not in instances:
+                errors.append({'index': index, 'id': d.get('id') if isinstance(d, dict) else None,
+                               'message': 'Resource not found'})
+            elif obj_id in seen:
+                errors.append({'index': index, 'id': obj_id, 'message': 'Resource repeated in request'})
+            else:
+                seen.add(obj_id)
+                rows.append((index, d, obj_id))
+
+        # every row is loaded and checked before anything is flushed, rejected rows are expired so their loaded
+        # values never reach the database and the rest are written with a single flush
+        savepoint = db.session.begin_nested()
+        accepted = []
+        with db.session.no_autoflush:
+            for index, d, obj_id in rows:
+                obj, changed, message = self.load_bulk_row(d, instances[obj_id], allowed)
+                if message is None:
+                    accepted.append((index, d, obj_id, obj, changed))
+                else:
+                    db.session.expire(instances[obj_id])
+                    errors.append({'index': index, 'id': obj_id, 'message': message})
+        try:
+            savepoint.commit()
+            objects, changes = [row[3] for row in accepted], [row[4] for row in accepted]
+        except IntegrityError:
+            # only now is every row given its own savepoint, to find the ones breaking a constraint
+            savepoint.rollback()
+            objects, changes = self.apply_bulk_rows(accepted, instances, allowed, errors)
+        errors.sort(key=lambda error: error['index'])
+
+        if errors:
+            sentry.captureMessage(errors)
+        if not objects:
+            db.session.rollback()
+            return {'error': True, 'message': 'No Resource Updated', 'errors': errors}, 400
+
+        try:
+            self.before_update_commit(objects, changes)
+            db.session.commit()
+        except IntegrityError:
+            sentry.captureException()
+            db.session.rollback()
+            raise SQLIntegrityError(data=data, message='Integrity Error', operation='Updating Resource', status=400)
+        except OperationalError:
+            sentry.captureException()
+            db.session.rollback()
+            raise SQlOperationalError(data=data, message='Operational Error', operation='Updating Resource',
+                                      status=400)
+        except InvalidRequestError:
+            sentry.captureException()
+            db.session.rollback()
+            raise SQlInvalidRequestError(data=data, message='Invalid Request Error', operation='Updating Resource',
+                                         status=400)
+        self.after_objects_save(objects)
+        return {'success': True, 'message': 'Resource Updated successfully', 'errors': errors,
+                'data': self.get_schema().dump(objects, many=True).data}, 207 if errors else 200
+
     def save_resource(self):
         data = request.json if isinstance(request.json, list) else [request.json]
         objects, errors = self.schema().load(data, session=db.session, many=True)
@@ -222,6 +657,8 @@ class ModelResource(ABC):
             db.session.rollback()
             return {'error': True, 'message': 'Forbidden Permission Denied To Add Resource'}, 403
         try:
+            db.session.flush()
+            self.before_objects_commit(objects)
             db.session.commit()
             self.after_objects_save(objects)
         except IntegrityError:
@@ -241,6 +678,64 @@ class ModelResource(ABC):
                 'data': self.schema(exclude=tuple(self.obj_exclude), only=tuple(self.obj_only))
                     .dump(objects, many=True).data}, 201
 
+    def bulk_save_resource(self):
+        data = request.json if isinstance(request.json, list) else [request.json]
+        rows, errors = self.schema().load_values(data, many=True)
+        if errors:
+            sentry.captureMessage(errors)
+            return {'error': True, 'message': str(errors)}, 400
+
+        table = self.model.__table__
+        columns = {column.key: column for column in table.columns}
+        # permission hooks only read and set attributes, plain namespaces spare the ORM bookkeeping
+        objects = [SimpleNamespace(**{k: v for k, v in row.items() if k in columns}) for row in rows]
+        if not self.has_add_permission(objects):
+            return {'error': True, 'message': 'Forbidden Permission Denied To Add Resource'}, 403
+
+        # a multi row VALUES clause needs the same keys on every row. missing keys are filled where the column
+        # default is a plain value, rows that leave out a server side or callable default are inserted separately
+        # so the database still applies it
+        defaults = {}
+        for key in set().union(*[vars(obj) for obj in objects]):
+            column = columns[key]
+            if column.default is not None and column.default.is_scalar:
+                defaults[key] = column.default.arg
+            elif column.default is None and column.server_default is None:
+                defaults[key] = None
+        groups = {}
+        for index, obj in enumerate(objects):
+            row = dict(defaults, **vars(obj))
+            groups.setdefault(frozenset(row), []).append((index, row))
+
+        ids = [None] * len(objects)
+        try:
+            for group in groups.values():
+                for chunk in chunked(group, self.bulk_chunk_size):
+                    inserted = [row_id for row_id, in db.session.execute(table.insert()
+                                                                          .values([row for _, row in chunk])
+                                                                          .returning(table.c.id))]
+                    self.before_bulk_commit(inserted)
+                    for (index, _), row_id in zip(chunk, inserted):
+                        ids[index] = row_id
+            db.session.commit()
+        except IntegrityError:
+            sentry.captureException()
+            db.session.rollback()
+            raise SQLIntegrityError(data={}, message='Integrity Error', operation='Adding Resource', status=400)
+        except OperationalError:
+            sentry.captureException()
+            db.session.rollback()
+            raise SQlOperationalError(data={}, message='Operational Error', operation='Adding Resource', status=400)
+        except InvalidRequestError:
+            sentry.captureException()
+            db.session.rollback()
+            raise SQlInvalidRequestError(data={}, message='Invalid Request Error', operation='Adding Resource',
+                                         status=400)
+
+        for chunk in chunked(ids, self.bulk_chunk_size):
+            self.after_bulk_save(chunk)
+        return {'success': True, 'message': 'Resource added successfully', 'data': [{'id': i} for i in ids]}, 201
+
     @abstractmethod
     def has_read_permission(self, qs):
         return qs
@@ -257,9 +752,29 @@ class ModelResource(ABC):
     def has_add_permission(self, obj) -> bool:
         return True
 
+    def has_bulk_change_permission(self, objects) -> bool:
+        # override to check a whole PUT batch with set based queries
+        return all(self.has_change_permission(obj) for obj in objects)
+
+    def before_objects_commit(self, objects) -> None:
+        # runs in the transaction that adds `objects`, after they are flushed
+        pass
+
+    def before_update_commit(self, objects, changes) -> None:
+        # runs in the transaction that updates `objects` through PUT or PATCH, after they are flushed. `changes`
+        # holds the tracked_fields each object changed
+        pass
+
     def after_objects_save(self, objects) -> None:
         pass
 
+    def before_bulk_commit(self, ids) -> None:
+        # runs inside the insert transaction for every chunk written by bulk_save_resource
+        pass
+
+    def after_bulk_save(self, ids) -> None:
+        self.after_objects_save(self.model.query.filter(self.model.id.in_(ids)).all())
+
 
 class AssociationModelResource(ABC):
     model = None
@@ -288,6 +803,10 @@ class AssociationModelResource(ABC):
 
     auth_required = False
 
+    count_policy: str = 'exact'
+
+    count_cache_timeout: int = 60
+
     roles_accepted: Tuple[str] = ()
 
     roles_required: Tuple[str] = ()
@@ -332,6 +851,8 @@ class AssociationModelResource(ABC):
                                                          and int(
             request.args.get('__limit')) <= self.max_limit else self.default_limit
 
+        self.count_mode = get_count_policy(self.count_policy)
+
     def apply_filters(self, queryset, **kwargs):
         for k, v in kwargs.items():
             array_key = k.split('__')
@@ -355,6 +876,20 @@ class AssociationModelResource(ABC):
 
         return queryset
 
+    def get_count_cache_key(self):
+        filters = json.dumps(normalized_filters(), sort_keys=True)
+        return 'count:{0}:{1}:{2}'.format(self.__class__.__name__, getattr(current_user, 'id', None),
+                                          hashlib.sha1(filters.encode('utf-8')).hexdigest())
+
+    def get_total(self, queryset):
+        return count_queryset(queryset, self.count_mode, self.get_count_cache_key(), self.count_cache_timeout)
+
+    def paginate(self, queryset):
+        items = queryset.limit(self.limit).offset((self.page - 1) * self.limit).all()
+        if self.count_mode != 'none' and self.page == 1 and len(items) < self.limit:
+            return items, len(items)
+        return items, self.get_total(queryset)
+
     def add_relation(self, data):
         obj, errors = self.schema().load(data, session=db.session)
         if errors:
@@ -477,17 +1012,45 @@ class DataResource(ABC):
 
     retail_shop_ids: List[str] = []
 
-    end_date = datetime.now()
+    end_date: datetime = None
 
-    start_date = datetime.now() - relativedelta(days=30)
+    start_date: datetime = None
 
     roles_accepted: Tuple[str] = ('admin', 'owner')
 
-    headers: List[Tuple[str]] = ()
+    # output column order, columns that are not listed are appended after these
+    headers: Tuple[str] = ()
 
+    # dimensions used when the request does not pass __group_by, all of them if empty
     group_by: Tuple[str] = ()
 
+    # name -> column or sql expression the report can be grouped by
+    dimensions: Dict[str, Any] = {}
+
+    # name -> aggregate expression computed for every group
+    measures: Dict[str, Any] = {}
+
+    # model column the start_date / end_date window is applied to
+    date_column: str = None
+
+    # pre-aggregated daily model the report is read from when every requested dimension, measure and filter is
+    # declared for it and the window starts and ends at midnight, see can_use_rollup
+    rollup = None
+
+    rollup_dimensions: Dict[str, Any] = {}
+
+    rollup_measures: Dict[str, Any] = {}
+
+    rollup_date_column: str = None
+
+    rollup_filters: Tuple[str] = ()
+
+    export_chunk_size: int = 1000
+
     def __init__(self):
+        self.source = self.model
+        self.end_date = datetime.combine(date.today(), time()) + relativedelta(days=1)
+        self.start_date = self.end_date - relativedelta(days=30)
         try:
             if len(request.args.getlist('__retail_shop_id__in')):
                 outlets = request.args.getlist('__retail_shop_id__in')
@@ -495,7 +1058,7 @@ class DataResource(ABC):
                     outlets = outlets[0].split(',')
                 self.retail_shop_ids = outlets
             else:
-                self.retail_shop_ids = current_user.retail_shop_ids
+                self.retail_shop_ids = getattr(current_user, 'retail_shop_ids', [])
 
             if '__start_date__equal' in request.args:
                 self.start_date = datetime.strptime(request.args.get('__start_date__equal'), '%Y-%m-%dT%H:%M:%S.%fZ')
@@ -514,7 +1077,8 @@ class DataResource(ABC):
                 self.start_date = self.end_date - relativedelta(days=1)
 
             if self.retail_shop_ids.__len__() == 1:
-                if current_user.has_permission('block_open_reports') and self.block_report:
+                if hasattr(current_user, 'has_permission') and current_user.has_permission('block_open_reports') \
+                        and self.block_report:
                     last_closing = current_user.last_closing_time(self.retail_shop_ids[0])
                     print(last_closing, self.start_date, self.end_date)
                     if last_closing < self.start_date or last_closing < self.end_date:
@@ -533,7 +1097,7 @@ class DataResource(ABC):
             if array_key[0] == '' and array_key[1] in self.filters.keys():
                 for operator in self.filters.get(array_key[1]):
                     if operator.op == array_key[2]:
-                        queryset = operator().prepare_queryset(queryset, self.model, array_key[1], v)
+                        queryset = operator().prepare_queryset(queryset, self.source, array_key[1], v)
 
             elif array_key[0] == '' and array_key[1] in self.external_filter.keys():
                 query_filter = self.external_filter.get(array_key[1])
@@ -564,10 +1128,71 @@ class DataResource(ABC):
                     queryset = queryset.order_by(getattr(self.model, order_by))
         return queryset
 
-    @abstractmethod
+    def get_dimensions(self):
+        names = get_list_param('__group_by') or list(self.group_by) or list(self.dimensions)
+        for name in names:
+            if name not in self.dimensions:
+                raise CustomException(data={'__group_by': name}, message='Invalid group by', operation='Query Report')
+        return names
+
+    def get_report_ordering(self, columns, dimensions):
+        ordering = []
+        for order_by in get_list_param('__order_by'):
+            name = order_by.lstrip('-')
+            if name in columns:
+                ordering.append(columns[name].desc() if order_by.startswith('-') else columns[name])
+        return ordering or [columns[name] for name in dimensions]
+
+    def can_use_rollup(self):
+        if self.rollup is None or '__distinct_by' in request.args:
+            return False
+        if self.start_date.time() != time() or self.end_date.time() != time():
+            return False
+        filters = {key.split('__')[1] for key in request.args.keys() if key.startswith('__') and key.count('__') > 1}
+        filters &= set(self.filters) | set(self.external_filter)
+        return filters <= set(self.rollup_filters) and set(self.get_dimensions()) <= set(self.rollup_dimensions) \
+            and set(self.measures) <= set(self.rollup_measures)
+
     def construct_query_set(self):
-        return
+        dimensions = self.get_dimensions()
+        if self.can_use_rollup():
+            self.source = self.rollup
+            declared_dimensions, measures = self.rollup_dimensions, self.rollup_measures
+            date_column = getattr(self.rollup, self.rollup_date_column)
+            start_date, end_date = self.start_date.date(), self.end_date.date()
+        else:
+            self.source = self.model
+            declared_dimensions, measures = self.dimensions, self.measures
+            date_column = getattr(self.model, self.date_column) if self.date_column else None
+            start_date, end_date = self.start_date, self.end_date
+
+        columns = {name: declared_dimensions[name].label(name) for name in dimensions}
+        columns.update((name, measures[name].label(name)) for name in self.measures)
+
+        queryset = self.source.query.with_entities(*[columns[name] for name in self.get_export_headers()])
+        if date_column is not None:
+            queryset = queryset.filter(date_column >= start_date, date_column < end_date)
+        queryset = self.has_read_permission(queryset)
+        return queryset.group_by(*[declared_dimensions[name] for name in dimensions]) \
+            .order_by(*self.get_report_ordering(columns, dimensions))
+
+    def has_read_permission(self, qs):
+        return qs
+
+    def paginate(self, queryset):
+        items = queryset.limit(self.limit).offset((self.page - 1) * self.limit).all()
+        if self.page == 1 and len(items) < self.limit:
+            return items, len(items)
+        return items, queryset.order_by(None).count()
 
     def get_export_headers(self):
+        columns = self.get_dimensions() + list(self.measures)
+        return [name for name in self.headers if name in columns] + \
+               [name for name in columns if name not in self.headers]
+
+    def get_export_queryset(self):
+        return self.apply_filters(self.construct_query_set(), **request.args), None
 
-        return self.headers
+    def export_rows(self, queryset, schema):
+        for row in queryset.yield_per(self.export_chunk_size):
+            yield row._asdict()
@@ -1,5 +1,6 @@
 from flask_marshmallow import Marshmallow
 import simplejson
+from marshmallow import post_load
 from marshmallow_sqlalchemy import ModelSchema, ModelSchemaOpts
 from .models import db
 
@@ -23,3 +24,17 @@ class BaseOpts(ModelSchemaOpts):
 
 class BaseSchema(ModelSchema):
     OPTIONS_CLASS = BaseOpts
+
+    @post_load
+    def make_instance(self, data, **kwargs):
+        if self.context.get('load_values'):
+            return data
+        return super(BaseSchema, self).make_instance(data, **kwargs)
+
+    def load_values(self, data, many=False):
+        # validated, deserialized dicts without building model instances, for bulk inserts
+        self.context['load_values'] = True
+        try:
+            return self.load(data, many=many)
+        finally:
+            self.context.pop('load_values', None)
@@ -1,5 +1,10 @@
-import requests
-from requests.exceptions import Timeout, ConnectionError
+import json
+import uuid
+
+from requests.exceptions import Timeout, ConnectionError, RequestException
+from .celery import celery
+from .http_pool import http_pool
+from .redis import redis_store
 from .url_shortener import url_shortener
 
 
@@ -9,6 +14,13 @@ class SMS(object):
     url = None
     headers = {'content-type': 'application/json'}
 
+    batch_size = 500
+    status_timeout = 24 * 60 * 60
+    max_attempts = 3
+
+    # redis set of the queue keys that have ever been used, swept by flush_sms_queues
+    queues_key = 'sms:queues'
+
     def __init__(self, app=None):
         if app is not None:
             self.init_app(app)
@@ -16,6 +28,9 @@ class SMS(object):
     def init_app(self, app=None):
         self.key = app.config.get('MSG91_KEY', None)
         self.url = app.config.get('MSG91_URL', None)
+        self.batch_size = app.config.get('SMS_BATCH_SIZE', self.batch_size)
+        self.status_timeout = app.config.get('SMS_STATUS_TIMEOUT', self.status_timeout)
+        self.max_attempts = app.config.get('SMS_MAX_ATTEMPTS', self.max_attempts)
 
     @staticmethod
     def sms_short_link_generator(link):
@@ -23,12 +38,107 @@ class SMS(object):
 
     def send_sms(self, sender='PAYNUD', route=4, country=91, key=None, content: str = None):
         try:
-            response = requests.post(self.url, json=dict(sender=sender, route=route, country=country, sms=content),
-                                     headers={'content-type': 'application/json', 'authkey': key or self.key}, timeout=5)
+            response = http_pool.post(self.url, json=dict(sender=sender, route=route, country=country, sms=content),
+                                     headers={'content-type': 'application/json', 'authkey': key or self.key})
         except (Timeout, ConnectionError) as e:
             print(e)
             raise e
         return response
 
+    @staticmethod
+    def queue_key(sender, route, country):
+        return 'sms:queue:{0}:{1}:{2}'.format(sender, route, country)
+
+    @staticmethod
+    def status_key(message_id):
+        return 'sms:status:{0}'.format(message_id)
+
+    def set_status(self, pipe, message_ids, **status):
+        for message_id in message_ids:
+            pipe.hmset(self.status_key(message_id), status)
+            pipe.expire(self.status_key(message_id), self.status_timeout)
+
+    def queue_sms(self, content, sender='PAYNUD', route=4, country=91):
+        # same content format as send_sms, returns one message id per entry for get_status
+        key = self.queue_key(sender, route, country)
+        messages = [dict(id=uuid.uuid4().hex, message=entry['message'], to=entry['to'], attempts=0)
+                    for entry in content]
+        pipe = redis_store.pipeline()
+        pipe.sadd(self.queues_key, key)
+        pipe.rpush(key, *[json.dumps(message) for message in messages])
+        self.set_status(pipe, [message['id'] for message in messages], status='queued')
+        length = pipe.execute()[1]
+
+        # flush as soon as a full batch is waiting, anything smaller goes out with the periodic flush
+        if length // self.batch_size > (length - len(messages)) // self.batch_size:
+            flush_sms_queue.delay(key)
+        return [message['id'] for message in messages]
+
+    def get_status(self, message_ids):
+        pipe = redis_store.pipeline()
+        for message_id in message_ids:
+            pipe.hgetall(self.status_key(message_id))
+        return {message_id: {key.decode('utf-8'): value.decode('utf-8') for key, value in status.items()} or None
+                for message_id, status in zip(message_ids, pipe.execute())}
+
+    @staticmethod
+    def merge_messages(messages):
+        # msg91 takes a list of recipients per message text, so identical texts share one entry
+        merged = {}
+        for message in messages:
+            merged.setdefault(message['message'], []).extend(message['to'])
+        return [dict(message=text, to=to) for text, to in merged.items()]
+
+    def flush(self, key):
+        _, _, sender, route, country = key.split(':')
+        pipe = redis_store.pipeline()
+        pipe.lrange(key, 0, self.batch_size - 1)
+        pipe.ltrim(key, self.batch_size, -1)
+        messages = [json.loads(message) for message in pipe.execute()[0]]
+        if not messages:
+            return 0
+
+        message_ids = [message['id'] for message in messages]
+        try:
+            response = self.send_sms(sender=sender, route=int(route), country=int(country),
+                                     content=self.merge_messages(messages))
+            response.raise_for_status()
+            result = response.json()
+        except (RequestException, ValueError) as e:
+            retry = [dict(message, attempts=message['attempts'] + 1) for message in messages
+                     if message['attempts'] + 1 < self.max_attempts]
+            pipe = redis_store.pipeline()
+            if retry:
+                pipe.rpush(key, *[json.dumps(message) for message in retry])
+                self.set_status(pipe, [message['id'] for message in retry], status='queued', error=str(e))
+            self.set_status(pipe, [message['id'] for message in messages
+                                   if message['attempts'] + 1 >= self.max_attempts], status='failed', error=str(e))
+            pipe.execute()
+            return 0
+
+        pipe = redis_store.pipeline()
+        if result.get('type') == 'success':
+            self.set_status(pipe, message_ids, status='sent', request_id=result.get('message', ''))
+        else:
+            self.set_status(pipe, message_ids, status='failed', error=result.get('message', ''))
+        pipe.execute()
+        return len(messages)
+
 
 sms = SMS()
+
+
+@celery.task(name='celery.flush_sms_queue')
+def flush_sms_queue(key):
+    return sms.flush(key)
+
+
+@celery.task(name='celery.flush_sms_queues')
+def flush_sms_queues():
+    sent = 0
+    for key in redis_store.smembers(sms.queues_key):
+        key = key.decode('utf-8')
+        # only what is queued now, failed batches pushed back wait for the next run
+        for _ in range(0, redis_store.llen(key), sms.batch_size):
+            sent += sms.flush(key)
+    return sent
@@ -1,6 +1,7 @@
-import requests
 from requests.exceptions import ConnectionError, Timeout
 
+from .http_pool import http_pool
+
 
 class GoogleUrlShortener(object):
 
@@ -23,8 +24,8 @@ class GoogleUrlShortener(object):
 
     def get_short_url(self, link):
         try:
-            r = requests.post(self.url, params=dict(key=self.key), json=dict(longUrl=self.domain+link),
-                              headers=self.headers, timeout=5)
+            r = http_pool.post(self.url, params=dict(key=self.key), json=dict(longUrl=self.domain+link),
+                               headers=self.headers)
         except (ConnectionError, Timeout) as e:
             print(e)
             raise e
@@ -33,7 +34,7 @@ class GoogleUrlShortener(object):
         return None
 
     def get_url_analytics(self, link):
-        r = requests.get(self.url, params=dict(key=self.key, shortUrl=link, projection='FULL'))
+        r = http_pool.get(self.url, params=dict(key=self.key, shortUrl=link, projection='FULL'))
         if 200 <= r.status_code < 300:
             return r.json()
         return None
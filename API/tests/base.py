@@ -0,0 +1,66 @@
+import json
+from datetime import date
+
+from flask_jwt_extended import create_access_token
+from flask_testing import TestCase
+from manager import app, db
+from src import configs, limiter, redis_store
+from src.dues.models import Due
+from src.user.models import Role, User, UserToUser
+
+
+class DatabaseTestCase(TestCase):
+
+    def create_app(self):
+        # pass in test configuration
+        app.config.from_object(configs.get('testing'))
+        limiter.enabled = False
+        return app
+
+    def setUp(self):
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        # drop_all trips over the enum named varchar, emptying the tables is enough between tests
+        db.session.execute('TRUNCATE {0} RESTART IDENTITY CASCADE'.format(
+            ', '.join('"{0}"'.format(table.name) for table in db.metadata.sorted_tables)))
+        db.session.commit()
+        redis_store.flushdb()
+
+    def create_user(self, mobile_number, **kwargs):
+        user = User(first_name='user_' + mobile_number, mobile_number=mobile_number, active=True, **kwargs)
+        db.session.add(user)
+        db.session.commit()
+        return user
+
+    def grant_role(self, user, name):
+        role = Role.query.filter_by(name=name).first() or Role(name=name)
+        user.roles.append(role)
+        db.session.commit()
+
+    def create_owner(self, mobile_number='9000000000', customers=1):
+        owner = self.create_user(mobile_number)
+        customers = [self.create_user('{0}{1}'.format(mobile_number[:-2], 10 + i)) for i in range(customers)]
+        db.session.add_all([UserToUser(business_owner_id=owner.id, customer_id=customer.id)
+                            for customer in customers])
+        db.session.commit()
+        return owner, customers
+
+    def create_dues(self, owner, customer, count, **kwargs):
+        dues = [Due(name='due_{0}'.format(i), creator_id=owner.id, customer_id=customer.id,
+                    **dict(dict(amount=10, transaction_type='fixed', due_date=date(2026, 1, 1)), **kwargs))
+                for i in range(count)]
+        db.session.add_all(dues)
+        db.session.commit()
+        return dues
+
+    def headers(self, user):
+        return {'authorization': 'Bearer ' + create_access_token(identity={'id': user.id}),
+                'content-type': 'application/json'}
+
+    def get_json(self, url, user, **params):
+        return self.client.get(url, query_string=params, headers=self.headers(user))
+
+    def post_json(self, url, user, data, **params):
+        return self.client.post(url, data=json.dumps(data), query_string=params, headers=self.headers(user))
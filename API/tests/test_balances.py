@@ -0,0 +1,67 @@
+from src import db
+from src.dues.models import Payment
+from src.user.models import UserToUser
+
+from .base import DatabaseTestCase
+
+
+class TestBalances(DatabaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.owner, (self.customer, self.other_customer) = self.create_owner(customers=2)
+
+    def balances(self):
+        db.session.expire_all()
+        return {link.customer_id: (link.outstanding_amount, link.active_subscriptions)
+                for link in UserToUser.query.filter_by(business_owner_id=self.owner.id)}
+
+    def assertBalances(self, expected):
+        self.assertEqual(self.balances(), {self.customer.id: expected[0], self.other_customer.id: expected[1]})
+        # whatever the counters say has to agree with a recount from the dues
+        self.assertEqual(UserToUser.rebuild_balances(verify_only=True), [])
+
+    def test_counters_follow_due_changes(self):
+        due, = self.create_dues(self.owner, self.customer, 1, amount=10)
+        subscription, = self.create_dues(self.owner, self.customer, 1, transaction_type='subscription')
+        self.assertBalances([(10, 1), (0, 0)])
+
+        due.amount = 25
+        db.session.commit()
+        self.assertBalances([(25, 1), (0, 0)])
+
+        due.customer_id = self.other_customer.id
+        db.session.commit()
+        self.assertBalances([(0, 1), (25, 0)])
+
+        db.session.add(Payment(due_id=due.id, razor_pay_id='pay_1'))
+        db.session.commit()
+        self.assertBalances([(0, 1), (0, 0)])
+
+        subscription.is_cancelled = True
+        db.session.commit()
+        self.assertBalances([(0, 0), (0, 0)])
+
+    def test_cancelled_due_stops_counting(self):
+        due, = self.create_dues(self.owner, self.customer, 1, amount=10)
+        due.is_cancelled = True
+        db.session.commit()
+        self.assertBalances([(0, 0), (0, 0)])
+
+        due.is_cancelled = False
+        db.session.commit()
+        self.assertBalances([(10, 0), (0, 0)])
+
+    def test_rebuild_balances(self):
+        self.create_dues(self.owner, self.customer, 2, amount=10)
+        UserToUser.query.filter_by(customer_id=self.customer.id)\
+            .update({UserToUser.outstanding_amount: 999, UserToUser.active_subscriptions: 3})
+        db.session.commit()
+
+        drifted = UserToUser.rebuild_balances(verify_only=True)
+        self.assertEqual([(row.customer_id, row.expected_amount, row.expected_subscriptions) for row in drifted],
+                         [(self.customer.id, 20, 0)])
+        self.assertEqual(self.balances()[self.customer.id], (999, 3))
+
+        self.assertEqual(len(UserToUser.rebuild_balances(business_owner_id=self.owner.id)), 1)
+        self.assertBalances([(20, 0), (0, 0)])
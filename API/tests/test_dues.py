@@ -0,0 +1,449 @@
+import asyncio
+import hashlib
+import hmac
+import json
+from threading import Thread
+from unittest import mock
+
+from flask import _request_ctx_stack
+from razorpay.constants import URL
+from razorpay.errors import ServerError
+from sqlalchemy.exc import OperationalError
+from src import async_http, db
+from src.dues.celerytasks import do_payments, process_razorpay_events, provision_customers
+from src.dues.models import Due, Payment, RazorpayEvent, SupersededInvoice
+from src.dues.resources import DueResource
+from src.user.models import User, UserToUser
+from src.utils.outbox import OutboxMessage
+
+from .base import DatabaseTestCase
+
+
+def due_data(customer, **kwargs):
+    return dict(dict(name='due', amount=10, transaction_type='fixed', customer_id=customer.id), **kwargs)
+
+
+class TestDuePermissions(DatabaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.owner, (self.customer, self.other_customer) = self.create_owner(customers=2)
+        self.stranger = self.create_user('9100000000')
+
+    def test_add_for_own_customers(self):
+        response = self.post_json('/api/v1/due', self.owner, [due_data(self.customer),
+                                                              due_data(self.other_customer)])
+        self.assertStatus(response, 201)
+        self.assertEqual({due.creator_id for due in Due.query}, {self.owner.id})
+
+    def test_add_for_stranger_is_rejected(self):
+        response = self.post_json('/api/v1/due', self.owner, [due_data(self.customer), due_data(self.stranger)])
+        self.assert403(response)
+        self.assertEqual(Due.query.count(), 0)
+
+    def test_customer_added_after_caching(self):
+        self.assertStatus(self.post_json('/api/v1/due', self.owner, due_data(self.customer)), 201)
+        db.session.add(UserToUser(business_owner_id=self.owner.id, customer_id=self.stranger.id))
+        db.session.commit()
+
+        # the cached customer set misses the new customer, the miss is confirmed against the database
+        self.assertStatus(self.post_json('/api/v1/due', self.owner, due_data(self.stranger)), 201)
+
+    def test_dues_of_other_owners_are_hidden(self):
+        other_owner, (other_customer,) = self.create_owner('9200000000')
+        self.create_dues(other_owner, other_customer, 2)
+        dues = self.create_dues(self.owner, self.customer, 1)
+
+        response = self.get_json('/api/v1/due', self.owner)
+        self.assertEqual([due['id'] for due in response.json['data']], [dues[0].id])
+
+
+class TestBulkUpdate(DatabaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        owner, (customer,) = self.create_owner()
+        other_owner, (stranger,) = self.create_owner('9200000000')
+        self.due_ids = [due.id for due in self.create_dues(owner, customer, 3)]
+        self.foreign_id = self.create_dues(other_owner, stranger, 1)[0].id
+        self.owner_id, self.customer, self.stranger = owner.id, customer, stranger
+
+    def bulk_update(self, data):
+        with self.app.test_request_context(method='PUT', json=data):
+            _request_ctx_stack.top.user = User.query.get(self.owner_id)
+            response, status = DueResource().bulk_update_resource()
+        db.session.remove()
+        return response, status
+
+    def names(self):
+        return dict(db.session.query(Due.id, Due.name))
+
+    def test_partial_failure(self):
+        first, second, third = self.due_ids
+        customer_id = self.customer.id
+        response, status = self.bulk_update([
+            due_data(self.customer, id=first, name='renamed'),
+            due_data(self.customer, id=self.foreign_id, name='stolen'),
+            due_data(self.customer, id=9999, name='missing'),
+            due_data(self.customer, id=second, name='bad', amount='ten'),
+            due_data(self.stranger, id=third, name='moved'),
+        ])
+
+        self.assertEqual(status, 207)
+        self.assertEqual([error['index'] for error in response['errors']], [1, 2, 3, 4])
+        self.assertEqual([due['id'] for due in response['data']], [first])
+        names = self.names()
+        self.assertEqual(names[first], 'renamed')
+        # rejected rows never reach the database, including one that only failed its check after loading
+        self.assertEqual([names[second], names[third], names[self.foreign_id]], ['due_1', 'due_2', 'due_0'])
+        self.assertEqual(Due.query.get(third).customer_id, customer_id)
+
+    def test_everything_rejected(self):
+        response, status = self.bulk_update([due_data(self.customer, id=self.foreign_id, name='stolen'),
+                                             due_data(self.stranger, id=self.due_ids[0], name='moved')])
+
+        self.assertEqual(status, 400)
+        self.assertEqual(len(response['errors']), 2)
+        names = self.names()
+        self.assertEqual([names[self.due_ids[0]], names[self.foreign_id]], ['due_0', 'due_0'])
+
+    def test_ids_are_coerced(self):
+        response, status = self.bulk_update([due_data(self.customer, id=str(self.due_ids[0]), name='renamed'),
+                                             due_data(self.customer, id='abc', name='bad'),
+                                             due_data(self.customer, id=True, name='bad')])
+
+        self.assertEqual(status, 207)
+        self.assertEqual([error['index'] for error in response['errors']], [1, 2])
+        self.assertEqual(self.names()[self.due_ids[0]], 'renamed')
+
+    def test_rows_are_flushed_together(self):
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement.split()[0])
+
+        db.event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            response, status = self.bulk_update([due_data(self.customer, id=due_id, name='renamed')
+                                                 for due_id in self.due_ids])
+        finally:
+            db.event.remove(db.engine, 'before_cursor_execute', record)
+
+        self.assertEqual(status, 200)
+        self.assertEqual(statements.count('SAVEPOINT'), 1)
+        self.assertEqual(set(self.names()[due_id] for due_id in self.due_ids), {'renamed'})
+
+    def test_constraint_violation_falls_back_to_rows(self):
+        first, second, third = self.due_ids
+        Due.query.filter_by(id=third).update({Due.razor_pay_id: 'inv_1'})
+        db.session.commit()
+
+        response, status = self.bulk_update([due_data(self.customer, id=first, name='renamed'),
+                                             due_data(self.customer, id=second, name='taken', razor_pay_id='inv_1'),
+                                             due_data(self.customer, id=first, name='again')])
+
+        self.assertEqual(status, 207)
+        self.assertEqual([(error['index'], error['id']) for error in response['errors']], [(1, second), (2, first)])
+        self.assertEqual(response['errors'][1]['message'], 'Resource repeated in request')
+        names = self.names()
+        self.assertEqual([names[first], names[second]], ['renamed', 'due_1'])
+        self.assertIsNone(Due.query.get(second).razor_pay_id)
+
+
+class TestBulkInsert(DatabaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.owner, (self.customer,) = self.create_owner()
+
+    def bulk_save(self, data):
+        return self.post_json('/api/v1/due', self.owner, data, __bulk='')
+
+    def test_defaults(self):
+        response = self.bulk_save([due_data(self.customer, name='first', months=6, reminder_stage=1),
+                                   due_data(self.customer, name='second'),
+                                   due_data(self.customer, name='third', transaction_type='subscription')])
+
+        self.assertStatus(response, 201)
+        ids = [row['id'] for row in response.json['data']]
+        dues = {due.name: due for due in Due.query.filter(Due.id.in_(ids))}
+        # ids come back in request order even though the rows are inserted in groups
+        self.assertEqual(ids, [dues[name].id for name in ('first', 'second', 'third')])
+        self.assertEqual([dues['first'].months, dues['second'].months], [6, 3])
+        self.assertEqual([dues['first'].reminder_stage, dues['second'].reminder_stage], [1, 0])
+        self.assertEqual({due.is_cancelled for due in dues.values()}, {False})
+        self.assertTrue(all(due.created_on for due in dues.values()))
+        self.assertEqual({due.creator_id for due in dues.values()}, {self.owner.id})
+
+    def test_balances(self):
+        self.assertStatus(self.bulk_save([due_data(self.customer, amount=10), due_data(self.customer, amount=15),
+                                          due_data(self.customer, transaction_type='subscription')]), 201)
+
+        balance = UserToUser.query.filter_by(business_owner_id=self.owner.id, customer_id=self.customer.id).one()
+        self.assertEqual((balance.outstanding_amount, balance.active_subscriptions), (25, 1))
+
+    def test_stranger_is_rejected(self):
+        stranger = self.create_user('9100000000')
+        self.assert403(self.bulk_save([due_data(self.customer), due_data(stranger)]))
+        self.assertEqual(Due.query.count(), 0)
+
+    def test_invalid_rows(self):
+        self.assert400(self.bulk_save([due_data(self.customer), due_data(self.customer, amount='ten')]))
+        self.assertEqual(Due.query.count(), 0)
+
+
+class TestInvoiceNumbers(DatabaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.owner, (self.customer,) = self.create_owner()
+
+    def invoice_numbers(self, owner):
+        return [num for num, in db.session.query(Due.invoice_num).filter(Due.creator_id == owner.id)
+                .order_by(Due.invoice_num)]
+
+    def test_numbers_have_no_gaps(self):
+        self.post_json('/api/v1/due', self.owner, due_data(self.customer))
+        self.post_json('/api/v1/due', self.owner, [due_data(self.customer)] * 3)
+        self.post_json('/api/v1/due', self.owner, [due_data(self.customer)] * 4, __bulk='')
+
+        self.assertEqual(self.invoice_numbers(self.owner), list(range(1, 9)))
+        self.assertEqual(User.query.get(self.owner.id).counter, 8)
+
+    def test_owners_number_separately(self):
+        other_owner, (other_customer,) = self.create_owner('9200000000')
+        self.post_json('/api/v1/due', self.owner, [due_data(self.customer)] * 2)
+        self.post_json('/api/v1/due', other_owner, [due_data(other_customer)] * 3)
+
+        self.assertEqual(self.invoice_numbers(self.owner), [1, 2])
+        self.assertEqual(self.invoice_numbers(other_owner), [1, 2, 3])
+
+    def test_concurrent_creates(self):
+        headers = self.headers(self.owner)
+        data = json.dumps([due_data(self.customer)] * 5)
+
+        def create():
+            with self.app.test_client() as client:
+                for _ in range(3):
+                    client.post('/api/v1/due', data=data, query_string={'__bulk': ''}, headers=headers)
+
+        threads = [Thread(target=create) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.invoice_numbers(self.owner), list(range(1, 61)))
+
+    def patch(self, due_id, data):
+        return self.client.patch('/api/v1/due/{0}'.format(due_id), data=json.dumps(data),
+                                 headers=self.headers(self.owner))
+
+    def create_invoiced(self):
+        response = self.post_json('/api/v1/due', self.owner, [due_data(self.customer)] * 2, __only='id')
+        due_id = response.json['data'][0]['id']
+        Due.query.filter_by(id=due_id).update({Due.razor_pay_id: 'inv_1'})
+        db.session.commit()
+        return due_id
+
+    def test_edit_keeps_the_invoice(self):
+        due_id = self.create_invoiced()
+
+        self.assert200(self.patch(due_id, {'name': 'renamed', 'amount': 10}))
+        due = Due.query.get(due_id)
+        self.assertEqual((due.invoice_num, due.razor_pay_id), (1, 'inv_1'))
+        self.assertEqual(SupersededInvoice.query.count(), 0)
+
+    def test_amount_change_reissues_the_invoice(self):
+        due_id = self.create_invoiced()
+        messages = OutboxMessage.query.count()
+
+        self.assert200(self.patch(due_id, {'amount': 20}))
+        due = Due.query.get(due_id)
+        self.assertEqual((due.invoice_num, due.razor_pay_id), (3, None))
+        self.assertEqual(self.invoice_numbers(self.owner), [2, 3])
+        self.assertEqual([(invoice.razor_pay_id, invoice.due_id) for invoice in SupersededInvoice.query],
+                         [('inv_1', due_id)])
+        queued = OutboxMessage.query.order_by(OutboxMessage.id).offset(messages)
+        self.assertEqual(sorted((message.task, message.args) for message in queued),
+                         [('celery.cancel_invoices', [['inv_1']]), ('celery.do_payments', [[due_id]])])
+
+    def test_superseded_invoice_settles_its_due(self):
+        due_id = self.create_invoiced()
+        self.assert200(self.patch(due_id, {'amount': 20}))
+
+        recorded, unmatched = Payment.record(db.session.connection(), [('pay_1', 'inv_1', 1700000000)])
+        db.session.commit()
+        self.assertEqual((recorded, unmatched), (1, set()))
+        self.assertTrue(Due.query.get(due_id).is_paid)
+
+
+class TestRazorpayWebhook(DatabaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.app.config['RAZOR_PAY_WEBHOOK_SECRET'] = 'secret'
+        self.owner, (self.customer,) = self.create_owner()
+        self.due, = self.create_dues(self.owner, self.customer, 1, razor_pay_id='inv_1')
+
+    def event(self, payment_id, invoice_id='inv_1', event='invoice.paid'):
+        return {'event': event, 'payload': {'payment': {'entity': {'id': payment_id, 'created_at': 1700000000}},
+                                            'invoice': {'entity': {'id': invoice_id}}}}
+
+    def deliver(self, payload, event_id, signature=None):
+        body = json.dumps(payload)
+        if signature is None:
+            signature = hmac.new(b'secret', body.encode('utf-8'), hashlib.sha256).hexdigest()
+        return self.client.post('/api/v1/razorpay/webhook/', data=body,
+                                headers={'X-Razorpay-Signature': signature, 'X-Razorpay-Event-Id': event_id,
+                                         'content-type': 'application/json'})
+
+    def balance(self):
+        return UserToUser.query.filter_by(business_owner_id=self.owner.id, customer_id=self.customer.id) \
+            .one().outstanding_amount
+
+    def test_unconfigured_secret(self):
+        self.app.config['RAZOR_PAY_WEBHOOK_SECRET'] = None
+        self.assertStatus(self.deliver(self.event('pay_1'), 'evt_1'), 503)
+        self.assertEqual(RazorpayEvent.query.count(), 0)
+
+    def test_invalid_signature(self):
+        self.assert400(self.deliver(self.event('pay_1'), 'evt_1', signature='forged'))
+        self.assertEqual(RazorpayEvent.query.count(), 0)
+
+    def test_redelivered_event_is_stored_once(self):
+        self.assert200(self.deliver(self.event('pay_1'), 'evt_1'))
+        self.assert200(self.deliver(self.event('pay_1'), 'evt_1'))
+        self.assertEqual(RazorpayEvent.query.count(), 1)
+
+    def test_payment_is_recorded_once(self):
+        self.assertEqual(self.balance(), 10)
+        # razorpay may send the same payment under different event ids
+        self.deliver(self.event('pay_1'), 'evt_1')
+        self.deliver(self.event('pay_1'), 'evt_2')
+
+        self.assertEqual(process_razorpay_events(), 1)
+        self.assert200(self.deliver(self.event('pay_1'), 'evt_3'))
+        self.assertEqual(process_razorpay_events(), 0)
+
+        self.assertEqual([payment.due_id for payment in Payment.query], [self.due.id])
+        self.assertIsNotNone(Due.query.get(self.due.id).paid_on)
+        self.assertEqual(self.balance(), 0)
+        self.assertEqual(RazorpayEvent.query.filter(RazorpayEvent.processed_on.is_(None)).count(), 0)
+
+    def test_unmatched_event_waits_for_its_due(self):
+        self.deliver(self.event('pay_2', invoice_id='inv_2'), 'evt_1')
+
+        self.assertEqual(process_razorpay_events(), 0)
+        event = RazorpayEvent.query.one()
+        self.assertEqual((event.processed_on, event.attempts), (None, 1))
+        self.assertIsNotNone(event.retry_after)
+
+    def test_subscription_renewal_invoice_is_ignored(self):
+        subscription, = self.create_dues(self.owner, self.customer, 1, transaction_type='subscription',
+                                         razor_pay_id='sub_1')
+        renewal = self.event('pay_3', invoice_id='inv_3')
+        renewal['payload']['invoice']['entity']['subscription_id'] = 'sub_1'
+        charged = {'event': 'subscription.charged',
+                   'payload': {'payment': {'entity': {'id': 'pay_3', 'created_at': 1700000000}},
+                               'subscription': {'entity': {'id': 'sub_1'}}}}
+        self.deliver(renewal, 'evt_1')
+        self.deliver(charged, 'evt_2')
+
+        self.assertEqual(process_razorpay_events(), 1)
+        # the renewal invoice is done with straight away, subscription.charged records the payment
+        events = {event.event_id: event for event in RazorpayEvent.query}
+        self.assertEqual([(event.processed_on is not None, event.attempts, event.error)
+                          for event in (events['evt_1'], events['evt_2'])], [(True, 0, None), (True, 0, None)])
+        self.assertEqual([payment.due_id for payment in Payment.query], [subscription.id])
+
+    def test_database_errors_keep_the_event_pending(self):
+        self.deliver(self.event('pay_1'), 'evt_1')
+
+        with mock.patch.object(Payment, 'record', side_effect=OperationalError('INSERT', {}, Exception('gone'))):
+            self.assertEqual(process_razorpay_events(), 0)
+        event = RazorpayEvent.query.one()
+        self.assertEqual((event.processed_on, event.attempts, event.error), (None, 1, None))
+
+        RazorpayEvent.query.update({RazorpayEvent.retry_after: None})
+        db.session.commit()
+        self.assertEqual(process_razorpay_events(), 1)
+        self.assertEqual(self.balance(), 0)
+
+    def test_malformed_event_does_not_block_the_queue(self):
+        self.deliver(self.event(None), 'evt_1')
+        self.deliver(self.event('pay_1'), 'evt_2')
+
+        self.assertEqual(process_razorpay_events(), 1)
+        events = {event.event_id: event for event in RazorpayEvent.query}
+        self.assertEqual(events['evt_1'].error, 'Malformed invoice.paid event')
+        self.assertIsNone(events['evt_2'].error)
+        self.assertEqual(self.balance(), 0)
+
+
+class FakeRazorpay(object):
+
+    def __init__(self, failing_contacts=()):
+        self.failing_contacts = set(failing_contacts)
+        self.created = 0
+
+    async def razorpay(self, method, path, data=None):
+        self.created += 1
+        if path == URL.CUSTOMER_URL:
+            if data['contact'] in self.failing_contacts:
+                raise ServerError('Service unavailable')
+            return {'id': 'cust_{0}'.format(self.created)}
+        return {'id': 'inv_{0}'.format(self.created), 'short_url': 'https://rzp.io/i/{0}'.format(self.created)}
+
+
+class TestPaymentLinks(DatabaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.owner, (self.customer, self.unreachable) = self.create_owner(customers=2)
+        self.due, = self.create_dues(self.owner, self.customer, 1)
+        self.skipped, = self.create_dues(self.owner, self.unreachable, 1)
+
+    def do_payments(self, due_ids, **kwargs):
+        razorpay = FakeRazorpay([self.unreachable.mobile_number])
+        with mock.patch.object(async_http, 'run', lambda fn, *args: asyncio.run(fn(razorpay, *args))), \
+                mock.patch.object(do_payments, 'apply_async') as retried, \
+                mock.patch('src.dues.celerytasks.sentry') as sentry:
+            sent = do_payments(due_ids, **kwargs)
+        return sent, retried, sentry
+
+    def test_failed_dues_are_retried(self):
+        due_id, skipped_id = self.due.id, self.skipped.id
+        sent, retried, sentry = self.do_payments([due_id, skipped_id])
+
+        self.assertEqual(sent, 1)
+        self.assertIsNotNone(Due.query.get(due_id).razor_pay_id)
+        self.assertIsNone(Due.query.get(skipped_id).razor_pay_id)
+        retried.assert_called_once_with(([skipped_id],), {'attempt': 1},
+                                        countdown=self.app.config['RAZORPAY_RETRY_DELAY'])
+        # the customer and the due it held up are both reported
+        self.assertEqual(sentry.captureException.call_count, 2)
+
+    def test_retries_give_up(self):
+        sent, retried, sentry = self.do_payments([self.skipped.id], attempt=self.app.config['RAZORPAY_MAX_RETRIES'])
+
+        self.assertEqual(sent, 0)
+        retried.assert_not_called()
+
+
+class TestProvisionCustomers(DatabaseTestCase):
+
+    def test_failed_customers_are_retried(self):
+        owner, customers = self.create_owner(customers=3)
+        owner_id, customer_ids = owner.id, [customer.id for customer in customers]
+        razorpay = FakeRazorpay([customers[1].mobile_number])
+        self.app.config['RAZORPAY_PROVISION_CHUNK_SIZE'] = 2
+
+        with mock.patch.object(async_http, 'run', lambda fn, *args: asyncio.run(fn(razorpay, *args))), \
+                mock.patch.object(provision_customers, 'apply_async') as retried:
+            self.assertEqual(provision_customers(owner_id), 2)
+
+        provisioned = dict(db.session.query(User.id, User.razor_pay_id).filter(User.id.in_(customer_ids)))
+        self.assertEqual([provisioned[customer_id] is not None for customer_id in customer_ids], [True, False, True])
+        retried.assert_called_once_with((owner_id,), {'attempt': 1},
+                                        countdown=self.app.config['RAZORPAY_RETRY_DELAY'])
@@ -0,0 +1,39 @@
+import os
+import tempfile
+import time
+
+from src.utils.export import cleanup_exports
+
+from .base import DatabaseTestCase
+
+
+class TestExportCleanup(DatabaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.folder = tempfile.TemporaryDirectory()
+        self.app.config['EXPORT_FOLDER'] = self.folder.name
+
+    def tearDown(self):
+        self.folder.cleanup()
+        super().tearDown()
+
+    def create_file(self, name, age):
+        path = os.path.join(self.folder.name, name)
+        open(path, 'w').close()
+        modified = time.time() - age
+        os.utime(path, (modified, modified))
+        return path
+
+    def test_expired_files_are_removed(self):
+        timeout = self.app.config['EXPORT_JOB_TIMEOUT']
+        expired = self.create_file('expired.csv', timeout + 60)
+        crashed = self.create_file('crashed.part.xlsx', timeout + 60)
+        recent = self.create_file('recent.csv', timeout - 60)
+
+        self.assertEqual(cleanup_exports(), 2)
+        self.assertEqual([os.path.exists(path) for path in (expired, crashed, recent)], [False, False, True])
+
+    def test_missing_folder(self):
+        self.app.config['EXPORT_FOLDER'] = os.path.join(self.folder.name, 'missing')
+        self.assertEqual(cleanup_exports(), 0)
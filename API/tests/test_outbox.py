@@ -0,0 +1,65 @@
+from unittest import mock
+
+from sqlalchemy.exc import OperationalError
+from src import celery, db, outbox
+from src.dues.celerytasks import do_payments, send_reminders
+from src.utils.outbox import OutboxMessage
+
+from .base import DatabaseTestCase
+
+
+class Stop(Exception):
+    pass
+
+
+class TestOutboxRelay(DatabaseTestCase):
+
+    def relay(self):
+        with mock.patch.object(celery, 'producer_or_acquire'), mock.patch.object(celery, 'send_task') as send_task:
+            outbox.relay()
+        return [(call[0][0], call[1]['args'], call[1]['kwargs']) for call in send_task.call_args_list]
+
+    def test_rolled_back_message_is_not_relayed(self):
+        outbox.enqueue(do_payments, [1, 2])
+        db.session.flush()
+        db.session.rollback()
+
+        self.assertEqual(OutboxMessage.query.count(), 0)
+        self.assertEqual(self.relay(), [])
+
+    def test_committed_messages_are_relayed_once(self):
+        outbox.enqueue(do_payments, [1, 2])
+        outbox.enqueue(send_reminders, [3], 1)
+        outbox.enqueue(do_payments, [4])
+        db.session.commit()
+
+        # calls of a batchable task are merged, the rest go out as they were queued
+        self.assertEqual(self.relay(), [('celery.send_reminders', [[3], 1], {}),
+                                        ('celery.do_payments', [[1, 2, 4]], {})])
+        self.assertEqual(OutboxMessage.query.count(), 0)
+        self.assertEqual(self.relay(), [])
+
+    def test_broker_failure_keeps_the_messages(self):
+        outbox.enqueue(do_payments, [1])
+        db.session.commit()
+
+        with mock.patch.object(celery, 'producer_or_acquire'), \
+                mock.patch.object(celery, 'send_task', side_effect=ConnectionError('broker')):
+            with self.assertRaises(ConnectionError):
+                outbox.relay()
+
+        self.assertEqual(OutboxMessage.query.count(), 1)
+        self.assertEqual(self.relay(), [('celery.do_payments', [[1]], {})])
+
+    def test_run_survives_failures(self):
+        relay = mock.patch.object(outbox, 'relay', side_effect=[OperationalError('DELETE', {}, Exception('gone')),
+                                                                ConnectionError('broker'), outbox.batch_size, 0])
+        sleep = mock.patch('src.utils.outbox.time.sleep', side_effect=[None, None, Stop()])
+        with relay as relayed, sleep as slept:
+            with self.assertRaises(Stop):
+                outbox.run()
+
+        self.assertEqual(relayed.call_count, 4)
+        # backs off after each failure, a full batch is followed straight away by the next one
+        delays = [call[0][0] for call in slept.call_args_list]
+        self.assertEqual(delays, [outbox.poll_interval * 2, outbox.poll_interval * 4, outbox.poll_interval])
@@ -0,0 +1,81 @@
+from datetime import timedelta
+from threading import Thread
+
+from sqlalchemy import func, select
+from src import db
+from src.dues.models import Due, REMINDER_BEFORE_DUE_DATE, REMINDER_ON_DUE_DATE
+
+from .base import DatabaseTestCase
+
+
+class TestClaimReminders(DatabaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.owner, (self.customer,) = self.create_owner()
+        self.today = db.session.execute(select([func.current_date()])).scalar()
+
+    def create_subscriptions(self, count, days, **kwargs):
+        return [due.id for due in self.create_dues(self.owner, self.customer, count, transaction_type='subscription',
+                                                   due_date=self.today + timedelta(days=days), **kwargs)]
+
+    def claim(self, stage, **kwargs):
+        claimed = Due.claim_reminders(db.session.connection(), stage, **kwargs)
+        db.session.commit()
+        return sorted(claimed)
+
+    def test_each_stage_is_claimed_once(self):
+        soon = self.create_subscriptions(2, 2)
+        today = self.create_subscriptions(1, 0)
+
+        self.assertEqual(self.claim(REMINDER_BEFORE_DUE_DATE), soon)
+        self.assertEqual(self.claim(REMINDER_BEFORE_DUE_DATE), [])
+        self.assertEqual(self.claim(REMINDER_ON_DUE_DATE), today)
+        self.assertEqual(self.claim(REMINDER_ON_DUE_DATE), [])
+
+    def test_later_stage_after_earlier_one(self):
+        due_ids = self.create_subscriptions(1, 0)
+        Due.query.filter(Due.id.in_(due_ids)).update({Due.reminder_stage: REMINDER_BEFORE_DUE_DATE},
+                                                     synchronize_session=False)
+        db.session.commit()
+
+        self.assertEqual(self.claim(REMINDER_BEFORE_DUE_DATE), [])
+        self.assertEqual(self.claim(REMINDER_ON_DUE_DATE), due_ids)
+
+    def test_only_open_subscriptions_in_the_window(self):
+        self.create_subscriptions(1, 0, is_cancelled=True)
+        self.create_subscriptions(1, 10)
+        self.create_subscriptions(1, -3)
+        self.create_dues(self.owner, self.customer, 1, due_date=self.today)
+        claimable = self.create_subscriptions(1, -1)
+
+        self.assertEqual(self.claim(REMINDER_ON_DUE_DATE), claimable)
+
+    def test_limit_and_due_ids(self):
+        due_ids = self.create_subscriptions(5, 0)
+
+        self.assertEqual(self.claim(REMINDER_ON_DUE_DATE, due_ids=due_ids[3:]), due_ids[3:])
+        self.assertEqual(self.claim(REMINDER_ON_DUE_DATE, limit=2), due_ids[:2])
+        self.assertEqual(self.claim(REMINDER_ON_DUE_DATE, limit=2), due_ids[2:3])
+
+    def test_concurrent_claims(self):
+        due_ids = self.create_subscriptions(60, 0)
+        claims, engine = [], db.engine
+
+        def sweep():
+            # every worker has its own connection, like separate celery processes
+            with engine.connect() as connection:
+                while True:
+                    with connection.begin():
+                        claimed = Due.claim_reminders(connection, REMINDER_ON_DUE_DATE, limit=4)
+                    if not claimed:
+                        return
+                    claims.extend(claimed)
+
+        threads = [Thread(target=sweep) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(claims), due_ids)
@@ -0,0 +1,114 @@
+from datetime import datetime, timezone
+
+from sqlalchemy import func, select
+from src import db
+from src.dues.models import DueDailyRollup, Payment
+
+from .base import DatabaseTestCase
+
+
+class TestReportAccess(DatabaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.owner, (self.customer,) = self.create_owner()
+        self.other_owner, (self.other_customer,) = self.create_owner('9200000000')
+        self.create_dues(self.owner, self.customer, 2, amount=10)
+        self.create_dues(self.other_owner, self.other_customer, 3, amount=50)
+
+    def test_role_is_required(self):
+        # flask_security answers a failed role check by redirecting to its unauthorized view
+        self.assertStatus(self.get_json('/api/v1/report', self.customer), 302)
+
+    def test_report_is_scoped_to_the_owner(self):
+        self.grant_role(self.owner, 'owner')
+
+        response = self.get_json('/api/v1/report', self.owner, __group_by='customer_id')
+        self.assert200(response)
+        self.assertEqual([(row['customer_id'], row['dues'], row['amount']) for row in response.json['data']],
+                         [(self.customer.id, 2, 20)])
+
+
+class TestReportQueries(DatabaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.owner, (self.customer, self.other_customer) = self.create_owner(customers=2)
+        self.grant_role(self.owner, 'owner')
+        self.create_dues(self.owner, self.customer, 2, amount=10)
+        self.create_dues(self.owner, self.other_customer, 1, amount=30, transaction_type='subscription')
+
+    def test_dimensions_and_measures(self):
+        response = self.get_json('/api/v1/report', self.owner, __group_by='month,customer_id', __order_by='-amount')
+        self.assert200(response)
+        rows = response.json['data']
+        self.assertEqual([(row['customer_id'], row['dues'], float(row['amount'])) for row in rows],
+                         [(self.other_customer.id, 1, 30), (self.customer.id, 2, 20)])
+        # every row of this month lands in the same bucket
+        self.assertEqual(len({row['month'] for row in rows}), 1)
+        self.assertNotIn('day', rows[0])
+
+    def test_filters(self):
+        response = self.get_json('/api/v1/report', self.owner, __group_by='customer_id',
+                                 __transaction_type__equal='fixed')
+        self.assert200(response)
+        self.assertEqual([row['customer_id'] for row in response.json['data']], [self.customer.id])
+
+    def test_invalid_group_by(self):
+        for group_by in ('name', 'created_on', 'customer_id,year'):
+            response = self.get_json('/api/v1/report', self.owner, __group_by=group_by)
+            self.assert400(response, group_by)
+            self.assertTrue(response.json['error'])
+
+
+class TestDueRollup(DatabaseTestCase):
+
+    def test_upsert_touches_updated_on(self):
+        owner, (customer,) = self.create_owner()
+        self.create_dues(owner, customer, 2)
+        DueDailyRollup.aggregate(db.session.connection())
+        DueDailyRollup.query.update({DueDailyRollup.updated_on: datetime(2020, 1, 1, tzinfo=timezone.utc)})
+        db.session.commit()
+
+        DueDailyRollup.aggregate(db.session.connection())
+        db.session.commit()
+        rollup = DueDailyRollup.query.one()
+        self.assertEqual(rollup.dues, 2)
+        self.assertGreater(rollup.updated_on, datetime(2020, 1, 2, tzinfo=timezone.utc))
+
+    def report(self, owner, **params):
+        response = self.get_json('/api/v1/report', owner, __group_by='transaction_type', **params)
+        self.assert200(response)
+        return [(row['transaction_type'], row['dues'], float(row['amount']), float(row['paid_amount']),
+                 row['cancelled']) for row in response.json['data']]
+
+    def test_rollup_matches_live_dues(self):
+        owner, (customer,) = self.create_owner()
+        self.grant_role(owner, 'owner')
+        paid, cancelled, _ = self.create_dues(owner, customer, 3, amount=10)
+        self.create_dues(owner, customer, 2, amount=25, transaction_type='subscription')
+        db.session.add(Payment(due_id=paid.id, razor_pay_id='pay_1'))
+        cancelled.is_cancelled = True
+        db.session.commit()
+        DueDailyRollup.rebuild()
+
+        expected = [('fixed', 2, 20, 10, 1), ('subscription', 2, 50, 0, 0)]
+        # a customer filter is not kept in the rollup, so the same report is answered from the dues themselves
+        self.assertEqual(self.report(owner), expected)
+        self.assertEqual(self.report(owner, __customer_id__equal=customer.id), expected)
+
+    def test_sweep_picks_up_changed_dues(self):
+        owner, (customer,) = self.create_owner()
+        self.grant_role(owner, 'owner')
+        due, _ = self.create_dues(owner, customer, 2, amount=10)
+        DueDailyRollup.rebuild()
+        since = db.session.execute(select([func.now()])).scalar()
+        db.session.commit()
+
+        due.amount = 40
+        self.create_dues(owner, customer, 1, amount=5, transaction_type='subscription')
+        self.assertEqual(self.report(owner), [('fixed', 2, 20, 0, 0)])
+
+        DueDailyRollup.sweep(since)
+        self.assertEqual(self.report(owner), self.report(owner, __customer_id__equal=customer.id))
+        self.assertEqual(self.report(owner), [('fixed', 2, 50, 0, 0), ('subscription', 1, 5, 0, 0)])
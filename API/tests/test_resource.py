@@ -0,0 +1,136 @@
+from datetime import date, datetime
+
+from .base import DatabaseTestCase
+
+
+class TestKeysetPagination(DatabaseTestCase):
+
+    def fetch_all(self, user, **params):
+        pages, cursor = [], ''
+        while cursor is not None:
+            response = self.get_json('/api/v1/due', user, __limit=3, __after=cursor, **params) if cursor else \
+                self.get_json('/api/v1/due', user, __limit=3, __cursor='', **params)
+            self.assert200(response)
+            pages.append([due['id'] for due in response.json['data']])
+            cursor = response.json['next_cursor']
+        return pages
+
+    def test_cursor_round_trip(self):
+        owner, (customer,) = self.create_owner()
+        dues = self.create_dues(owner, customer, 8)
+
+        pages = self.fetch_all(owner)
+        self.assertEqual([len(page) for page in pages], [3, 3, 2])
+        self.assertEqual(sum(pages, []), [due.id for due in dues])
+
+    def test_ties_are_broken_by_id(self):
+        owner, (customer,) = self.create_owner()
+        # every due shares the sort key, only the id tie-breaker tells them apart and follows its direction
+        dues = self.create_dues(owner, customer, 7, due_date=date(2026, 3, 1))
+
+        ids = sum(self.fetch_all(owner, __order_by='-due_date'), [])
+        self.assertEqual(ids, sorted((due.id for due in dues), reverse=True))
+        self.assertEqual(len(set(ids)), len(dues))
+
+    def test_descending_cursor_with_ties(self):
+        owner, (customer,) = self.create_owner()
+        dues = self.create_dues(owner, customer, 4, due_date=date(2026, 3, 1)) + \
+            self.create_dues(owner, customer, 4, due_date=date(2026, 4, 1))
+
+        ids = sum(self.fetch_all(owner, __order_by='-due_date,-id'), [])
+        expected = sorted(dues, key=lambda due: (due.due_date, due.id), reverse=True)
+        self.assertEqual(ids, [due.id for due in expected])
+
+    def test_list_has_no_total_with_cursor(self):
+        owner, (customer,) = self.create_owner()
+        self.create_dues(owner, customer, 5)
+
+        response = self.get_json('/api/v1/due', owner, __limit=2, __cursor='')
+        self.assertNotIn('total', response.json)
+
+    def test_invalid_cursor(self):
+        owner, (customer,) = self.create_owner()
+        self.create_dues(owner, customer, 2)
+
+        self.assert400(self.get_json('/api/v1/due', owner, __after='not-a-cursor'))
+
+
+class TestCountPolicies(DatabaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.owner, (self.customer,) = self.create_owner()
+        self.create_dues(self.owner, self.customer, 5)
+
+    def total(self, **params):
+        response = self.get_json('/api/v1/due', self.owner, **params)
+        self.assert200(response)
+        return response.json.get('total')
+
+    def test_exact_count(self):
+        self.assertEqual(self.total(__limit=2, __page=2), 5)
+        self.assertEqual(self.total(__limit=2, __page=2, __count='exact'), 5)
+
+    def test_no_count(self):
+        self.assertIsNone(self.total(__limit=2, __count='none'))
+
+    def test_first_page_skips_count(self):
+        self.assertEqual(self.total(__limit=10, __count='estimated'), 5)
+
+    def test_cached_count(self):
+        self.assertEqual(self.total(__limit=2, __page=2, __count='cached'), 5)
+        self.create_dues(self.owner, self.customer, 2)
+        self.assertEqual(self.total(__limit=2, __page=2, __count='cached'), 5)
+        # a different filter is a different cache entry
+        self.assertEqual(self.total(__limit=1, __count='cached', __id__equal=1), 1)
+
+    def test_estimated_count(self):
+        total = self.total(__limit=2, __page=2, __count='estimated')
+        self.assertIsInstance(total, int)
+        self.assertGreaterEqual(total, 0)
+
+    def test_cursor_defaults_to_no_count(self):
+        self.assertIsNone(self.total(__limit=2, __cursor=''))
+        self.assertEqual(self.total(__limit=2, __cursor='', __count='exact'), 5)
+
+
+class TestAggregation(DatabaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.owner, (self.customer,) = self.create_owner()
+        self.create_dues(self.owner, self.customer, 2, amount=10, due_date=date(2026, 1, 5))
+        self.create_dues(self.owner, self.customer, 1, amount=15, due_date=date(2026, 1, 20))
+        self.create_dues(self.owner, self.customer, 2, amount=25, due_date=date(2026, 2, 3),
+                         transaction_type='subscription')
+
+    def aggregate(self, **params):
+        response = self.get_json('/api/v1/due', self.owner, **params)
+        self.assert200(response)
+        return response.json['data']
+
+    def test_group_by_with_aggregates(self):
+        rows = self.aggregate(__group_by='transaction_type', __aggregate='count,sum:amount,max:amount')
+        self.assertEqual([(row['transaction_type'], row['count'], float(row['sum_amount']), float(row['max_amount']))
+                          for row in rows], [('fixed', 3, 35, 15), ('subscription', 2, 50, 25)])
+
+    def test_count_without_group_by(self):
+        self.assertEqual(self.aggregate(__aggregate='count'), [{'count': 5}])
+
+    def test_date_bucket(self):
+        rows = self.aggregate(__group_by='due_date:month', __aggregate='sum:amount')
+        # the api serialises datetimes as epoch milliseconds
+        self.assertEqual([(datetime.utcfromtimestamp(row['due_date'] / 1000).date(), float(row['sum_amount']))
+                          for row in rows], [(date(2026, 1, 1), 35), (date(2026, 2, 1), 50)])
+
+    def test_filters_apply_before_grouping(self):
+        rows = self.aggregate(__group_by='due_date:month', __aggregate='count', __transaction_type__equal='fixed')
+        self.assertEqual([row['count'] for row in rows], [3])
+
+    def test_invalid_queries(self):
+        for params in [dict(__group_by='name'), dict(__group_by='transaction_type:month'),
+                       dict(__group_by='due_date:fortnight'), dict(__aggregate='sum:name'),
+                       dict(__aggregate='median:amount'), dict(__aggregate='sum')]:
+            response = self.get_json('/api/v1/due', self.owner, **params)
+            self.assert400(response, params)
+            self.assertTrue(response.json['error'])